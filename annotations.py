@@ -0,0 +1,358 @@
+import ast
+import glob
+import os
+import pathlib
+import re
+import sqlite3
+import time
+import numpy as np
+
+OUTPUT_FILE_NAME = "patchlist.txt"
+LOG_FILE_NAME = "patchlist.log"
+DATABASE_FILE_NAME = "annotations.db"
+# Image, X, Y and size at the start of each line of a patch list
+RECORD_PREFIX = re.compile(r"^([^;\n]*);(-?\d+);(-?\d+);(\d+);", re.MULTILINE)
+
+
+def format_record(image, x, y, size, structure, classes, ambiguous, labelling_time):
+    """
+    Line of the patch list for the annotation of a crop
+    """
+    return image+";"+str(x)+";"+str(y)+";"+str(size)+";"+str(structure)+";"+str(classes)+";"+str(ambiguous)+";"+labelling_time+"\n"
+
+
+def parse_record(line):
+    """
+    Parse a line of the patch list
+    :return: dict with the image, X, Y, size, structure, classes, ambiguous and labelling_time
+             of the record, or None if the line is not a crop annotation
+    """
+    fields = line.rstrip("\n").split(";")
+    if len(fields) != 8:
+        return None
+    try:
+        return {"image": fields[0], "X": int(fields[1]), "Y": int(fields[2]), "size": int(fields[3]),
+                "structure": int(fields[4]), "classes": ast.literal_eval(fields[5]),
+                "ambiguous": ast.literal_eval(fields[6]), "labelling_time": fields[7]}
+    except (ValueError, SyntaxError):
+        return None
+
+
+def annotator_file_name(fname, annotator=None):
+    """
+    Name of an annotation file of an annotator sharing the output directory: patchlist.txt becomes
+    patchlist.<annotator>.txt
+    """
+    if annotator is None:
+        return fname
+    fnamesplit = os.path.splitext(fname)
+    return fnamesplit[0] + "." + annotator + fnamesplit[1]
+
+
+def open_annotations(outputpath, backend="text", annotator=None):
+    """
+    Open the annotation store of an output directory
+    :param backend: "text" for the patch list log or "sqlite" for the indexed database
+    :param annotator: Name of the annotator when several annotators share the output directory;
+                      each annotator writes to their own files
+    """
+    if backend == "sqlite":
+        return SQLiteAnnotationStore(outputpath, annotator)
+    return AnnotationLog(outputpath, annotator)
+
+
+def patchlist_files(outputpath):
+    """
+    Patch list files and logs of an output directory: the ones of a single annotator first, then
+    the ones of each annotator sharing the directory
+    """
+    fnames = [os.path.join(outputpath, OUTPUT_FILE_NAME), os.path.join(outputpath, LOG_FILE_NAME)]
+    # patchlist.<annotator>.txt and patchlist.<annotator>.log; the log of a running session may be alone
+    stems = set()
+    for fname in (OUTPUT_FILE_NAME, LOG_FILE_NAME):
+        stems.update(os.path.splitext(f)[0] for f in glob.glob(os.path.join(outputpath, annotator_file_name(fname, "*"))))
+    for stem in sorted(stems):
+        fnames += [stem + os.path.splitext(OUTPUT_FILE_NAME)[1], stem + os.path.splitext(LOG_FILE_NAME)[1]]
+    return fnames
+
+
+def annotations_exist(outputpath):
+    """
+    Check if the directory contains annotations of any backend
+    """
+    return any(glob.glob(os.path.join(outputpath, annotator_file_name(fname, "*"))) or os.path.exists(os.path.join(outputpath, fname))
+               for fname in (OUTPUT_FILE_NAME, LOG_FILE_NAME, DATABASE_FILE_NAME))
+
+
+def record_key(line):
+    """
+    Key of an annotation record: image, X and Y of the crop
+    :param line: Line of the patch list
+    """
+    return tuple(line.split(";", 3)[:3])
+
+
+def latest_lines(fnames):
+    """
+    Read patch list files in order, keeping the latest line of each crop
+    :param fnames: paths of the files; missing files are skipped
+    :return: dict of the lines by record key, in the order they were last written
+    """
+    records = {}
+    for fname in fnames:
+        if os.path.exists(fname):
+            with open(fname, "r") as file_object:
+                for line in file_object:
+                    if not line.strip():
+                        continue
+                    key = record_key(line)
+                    records.pop(key, None)
+                    records[key] = line if line.endswith("\n") else line + "\n"
+    return records
+
+
+def read_records(outputpath):
+    """
+    Read the crop annotations of an output directory, including the records of a session that is
+    still running or was not closed properly
+    :return: List of (line, record) tuples, see parse_record
+    """
+    lines = latest_lines(patchlist_files(outputpath))
+    records = []
+    for line in lines.values():
+        record = parse_record(line)
+        if record is not None:
+            records.append((line, record))
+    return records
+
+
+def annotated_crops_index(outputpath, crop_size, include_archives=False):
+    """
+    Index of the crops annotated in an output directory, by every annotator and backend. Each patch
+    list is parsed in one pass of a regular expression over the whole file. Images are identified by
+    their file name, so that the index still applies when the source directory moved
+    :param outputpath: Output directory of the annotator
+    :param crop_size: Size of the crops; annotations of crops of another size are ignored
+    :param include_archives: Also count the annotations of the patch lists archived with a timestamp
+    :return: dict of the sorted int64 keys of the annotated crops (Y << 32 | X) by image file name
+    """
+    fnames = patchlist_files(outputpath)
+    if include_archives:
+        fnamesplit = os.path.splitext(OUTPUT_FILE_NAME)
+        fnames += sorted(glob.glob(os.path.join(outputpath, fnamesplit[0] + "_*" + fnamesplit[1])))
+
+    rows = []
+    for fname in fnames:
+        if os.path.exists(fname):
+            with open(fname, "r") as file_object:
+                rows += RECORD_PREFIX.findall(file_object.read())
+    for fname in glob.glob(os.path.join(outputpath, annotator_file_name(DATABASE_FILE_NAME, "*"))) + [os.path.join(outputpath, DATABASE_FILE_NAME)]:
+        if os.path.exists(fname):
+            # Read only, the database can be the one of another annotator writing to it
+            connection = sqlite3.connect(pathlib.Path(fname).absolute().as_uri() + "?mode=ro", uri=True)
+            try:
+                rows += connection.execute("SELECT image, x, y, size FROM annotations").fetchall()
+            except sqlite3.Error as e:
+                print("Could not read", fname, ":", e)
+            connection.close()
+    if not rows:
+        return {}
+
+    images = np.array([row[0] for row in rows])
+    values = np.array([row[1:] for row in rows], dtype='int64')
+    keep = values[:, 2] == crop_size
+    images, values = images[keep], values[keep]
+    keys = (values[:, 1] << 32) | values[:, 0]
+
+    # Group the keys by image
+    names, inverse = np.unique(images, return_inverse=True)
+    order = np.argsort(inverse, kind='stable')
+    groups = np.split(keys[order], np.cumsum(np.bincount(inverse, minlength=len(names)))[:-1])
+    index = {}
+    for name, crops in zip(names, groups):
+        fname = os.path.basename(name)
+        index[fname] = np.union1d(index[fname], crops) if fname in index else np.unique(crops)
+    return index
+
+
+class AnnotationLog:
+
+    def __init__(self, outputpath, annotator=None):
+        """
+        Append-only log of the annotations of a session. A record supersedes any previous record
+        of the same crop, so correcting an annotation is a single append. compact() materializes
+        the patch list file with the latest record of each crop
+        :param outputpath: Directory of the patch list file
+        :param annotator: Name of the annotator, see annotator_file_name
+        """
+        self.outputpath = outputpath
+        self.output_file = os.path.join(outputpath, annotator_file_name(OUTPUT_FILE_NAME, annotator))
+        self.log_file = os.path.join(outputpath, annotator_file_name(LOG_FILE_NAME, annotator))
+        self.file_object = None
+
+        # Records left by a session that was not closed properly
+        self.compact()
+
+    def write(self, image, x, y, size, structure, classes, ambiguous, labelling_time):
+        """
+        Write the annotation of a crop to the log
+        """
+        if self.file_object is None:
+            self.file_object = open(self.log_file, "a")
+        self.file_object.write(format_record(image, x, y, size, structure, classes, ambiguous, labelling_time))
+
+    def flush(self, fsync=False):
+        """
+        Write the buffered records to the log
+        :param fsync: Also wait until the log is on the disk
+        """
+        if self.file_object is not None:
+            self.file_object.flush()
+            if fsync:
+                os.fsync(self.file_object.fileno())
+
+    def compact(self):
+        """
+        Merge the log into the patch list file, keeping the latest record of each crop, then empty the log
+        """
+        self.close()
+        if not os.path.exists(self.log_file):
+            return
+
+        records = latest_lines((self.output_file, self.log_file))
+
+        tmp_file = self.output_file + ".tmp"
+        with open(tmp_file, "w") as file_object:
+            file_object.writelines(records.values())
+        os.replace(tmp_file, self.output_file)
+        os.remove(self.log_file)
+
+    def archive(self, suffix):
+        """
+        Nothing to archive besides the patch list file; the log is empty after compaction
+        """
+        self.compact()
+
+    def close(self):
+        if self.file_object is not None:
+            self.file_object.close()
+            self.file_object = None
+
+
+class SQLiteAnnotationStore:
+
+    def __init__(self, outputpath, annotator=None):
+        """
+        Annotations stored in an indexed SQLite database. There is one row per crop, a new
+        annotation of a crop replaces the previous one. compact() exports the patch list file
+        :param outputpath: Directory of the database and of the patch list file
+        :param annotator: Name of the annotator, see annotator_file_name
+        """
+        self.outputpath = outputpath
+        self.database_name = annotator_file_name(DATABASE_FILE_NAME, annotator)
+        self.database_file = os.path.join(outputpath, self.database_name)
+        self.output_file = os.path.join(outputpath, annotator_file_name(OUTPUT_FILE_NAME, annotator))
+        self.connection = None
+
+    def connect(self):
+        """
+        Open the database, creating it on first use
+        """
+        if self.connection is not None:
+            return self.connection
+        new_database = not os.path.exists(self.database_file)
+        self.connection = sqlite3.connect(self.database_file, check_same_thread=False)
+        # The output directory can be a network share, where the WAL mode does not work; databases of
+        # earlier versions were switched to WAL, which persists in the file
+        self.connection.execute("PRAGMA journal_mode=DELETE")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS annotations (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                image TEXT NOT NULL, x INTEGER NOT NULL, y INTEGER NOT NULL, size INTEGER NOT NULL,
+                structure INTEGER NOT NULL,
+                class_1 REAL, class_2 REAL, class_3 REAL, class_4 REAL,
+                ambiguous_1 INTEGER, ambiguous_2 INTEGER, ambiguous_3 INTEGER, ambiguous_4 INTEGER,
+                labelling_time TEXT, annotated_at REAL NOT NULL
+            );
+            CREATE UNIQUE INDEX IF NOT EXISTS annotations_crop ON annotations (image, x, y);
+            CREATE INDEX IF NOT EXISTS annotations_structure ON annotations (structure);
+            CREATE INDEX IF NOT EXISTS annotations_time ON annotations (annotated_at);
+        """)
+        if new_database and os.path.exists(self.output_file):
+            # Keep the annotations of the existing patch list when it is exported again
+            self.import_patchlist(self.output_file)
+        return self.connection
+
+    INSERT = ("INSERT OR REPLACE INTO annotations (image, x, y, size, structure, class_1, class_2, class_3, class_4, "
+              "ambiguous_1, ambiguous_2, ambiguous_3, ambiguous_4, labelling_time, annotated_at) "
+              "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)")
+
+    @staticmethod
+    def row(image, x, y, size, structure, classes, ambiguous, labelling_time):
+        return (image, int(x), int(y), int(size), int(structure), *[float(c) for c in classes],
+                *[int(bool(a)) for a in ambiguous], labelling_time, time.time())
+
+    def write(self, image, x, y, size, structure, classes, ambiguous, labelling_time):
+        """
+        Write the annotation of a crop, replacing any previous annotation of the same crop
+        """
+        connection = self.connect()
+        with connection:
+            connection.execute(self.INSERT, self.row(image, x, y, size, structure, classes, ambiguous, labelling_time))
+
+    def flush(self, fsync=False):
+        """
+        Nothing to do, every write is a committed transaction
+        """
+
+    def import_patchlist(self, fname):
+        """
+        Add the crop annotations of a patch list file to the database
+        :param fname: path of the patch list file
+        """
+        rows = []
+        with open(fname, "r") as file_object:
+            for line in file_object:
+                record = parse_record(line)
+                if record is not None:
+                    rows.append(self.row(record["image"], record["X"], record["Y"], record["size"], record["structure"],
+                                         record["classes"], record["ambiguous"], record["labelling_time"]))
+        connection = self.connect()
+        with connection:
+            connection.executemany(self.INSERT, rows)
+
+    def export(self, fname):
+        """
+        Write the annotations in the patch list format, in the order they were written
+        :param fname: path of the patch list file
+        """
+        tmp_file = fname + ".tmp"
+        with open(tmp_file, "w") as file_object:
+            for row in self.connect().execute(
+                    "SELECT image, x, y, size, structure, class_1, class_2, class_3, class_4, "
+                    "ambiguous_1, ambiguous_2, ambiguous_3, ambiguous_4, labelling_time FROM annotations ORDER BY id"):
+                file_object.write(format_record(row[0], row[1], row[2], row[3], row[4], list(row[5:9]),
+                                                [bool(a) for a in row[9:13]], row[13]))
+        os.replace(tmp_file, fname)
+
+    def compact(self):
+        """
+        Export the patch list file so that it matches the database
+        """
+        if os.path.exists(self.database_file):
+            self.export(self.output_file)
+
+    def archive(self, suffix):
+        """
+        Move the database aside and start a new one
+        :param suffix: Suffix added to the name of the archived database
+        """
+        self.close()
+        if os.path.exists(self.database_file):
+            fnamesplit = os.path.splitext(self.database_name)
+            os.rename(self.database_file, os.path.join(self.outputpath, fnamesplit[0]+"_"+suffix+fnamesplit[1]))
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
@@ -0,0 +1,170 @@
+"""
+Benchmark of the Loader hot paths on synthetic two-channel junction images
+
+Usage: python benchmark.py [--sizes 1024 2048 4096] [--repeats 5] [--output benchmark.json]
+
+Each stage is run several times; the latency percentiles and the peak memory allocated during the
+stage (tracemalloc) are printed and saved as JSON, so that runs can be compared over time.
+"""
+from scipy.ndimage import zoom
+import argparse
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from datetime import datetime
+from loader import Loader
+
+# Number of crops extracted at once by the get_batch stage
+BATCH_SIZE = 64
+
+
+def synthetic_image(size, seed=0):
+    """
+    Two-channel image with a network of bright thin lines, like cell junctions, over a tissue region
+    :param size: Height and width of the image
+    :return: uint16 array with shape [channel, height, width]
+    """
+    rng = np.random.default_rng(seed)
+    image = np.empty((2, size, size), dtype='uint16')
+
+    # Contour lines of a smooth random field look like a junction network
+    field = zoom(rng.random((size//64 + 2, size//64 + 2)).astype('float32'), 64, order=1)[:size, :size]
+    junctions = np.exp(-((field % 0.1) - 0.05)**2 / 1e-4).astype('float32')
+    del field
+
+    # Tissue covers an ellipse in the middle of the image
+    y, x = np.ogrid[:size, :size]
+    tissue = (((y - size/2) / (0.4*size))**2 + ((x - size/2) / (0.45*size))**2) < 1
+
+    for c in range(2):
+        channel = rng.normal(100, 20, (size, size)).astype('float32')
+        channel += tissue * 400
+        channel += junctions * tissue * (2000 if c == 0 else 1000)
+        image[c] = np.clip(channel, 0, 65535)
+    return image
+
+
+def measure(fn, repeats):
+    """
+    Run fn several times
+    :return: List of durations in seconds and peak memory allocated in bytes
+    """
+    durations = []
+    tracemalloc.start()
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - start)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return durations, peak
+
+
+def summary(stage, size, durations, peak):
+    durations_ms = np.array(durations) * 1000
+    return {"stage": stage, "size": size, "n": len(durations),
+            "mean_ms": float(np.mean(durations_ms)), "p50_ms": float(np.percentile(durations_ms, 50)),
+            "p90_ms": float(np.percentile(durations_ms, 90)), "p99_ms": float(np.percentile(durations_ms, 99)),
+            "peak_mb": peak / 1024**2}
+
+
+def benchmark_size(size, repeats, n_crops, options, workdir):
+    """
+    Benchmark the Loader stages on one synthetic image
+    :return: List of stage summaries
+    """
+    import tifffile
+
+    image_dir = os.path.join(workdir, "images_%d" % size)
+    output_dir = os.path.join(workdir, "output_%d" % size)
+    os.makedirs(image_dir, exist_ok=True)
+    os.makedirs(output_dir, exist_ok=True)
+    img_path = os.path.join(image_dir, "synthetic.tif")
+    tifffile.imwrite(img_path, synthetic_image(size))
+
+    loader = Loader(path=image_dir, outputpath=output_dir, prefetch=0, **options)
+    results = []
+
+    durations, peak = measure(lambda: loader.load_image(img_path), repeats)
+    results.append(summary("load_image", size, durations, peak))
+
+    durations, peak = measure(lambda: loader.generate_crops(img_path), repeats)
+    results.append(summary("generate_crops", size, durations, peak))
+
+    durations, peak = measure(loader.foreground_mask, repeats)
+    results.append(summary("crop_scan", size, durations, peak))
+
+    n_crops = min(n_crops, len(loader.crop_data))
+    loader.n = 0
+    durations, peak = measure(loader.__next__, n_crops)
+    results.append(summary("__next__", size, durations, peak))
+
+    durations, peak = measure(loader.__previous__, n_crops - 1)
+    results.append(summary("__previous__", size, durations, peak))
+
+    # Time of a whole batch; compare to BATCH_SIZE times the __next__ time
+    batch = range(min(BATCH_SIZE, len(loader.crop_data)))
+    durations, peak = measure(lambda: loader.get_batch(batch), repeats)
+    results.append(summary("get_batch_%d" % len(batch), size, durations, peak))
+
+    classes, structures, ambiguous = [], [], []
+
+    def save():
+        loader.save_crop_data([0.5]*4, "00:00:01", 1, [False]*4)
+        classes.append([0.5]*4)
+        structures.append(1)
+        ambiguous.append([False]*4)
+
+    loader.n = 1
+    durations, peak = measure(save, n_crops)
+    results.append(summary("save_crop_data", size, durations, peak))
+
+    durations, peak = measure(lambda: loader.saveHistory(classes, structures, ambiguous), n_crops)
+    results.append(summary("saveHistory", size, durations, peak))
+
+    loader.close()
+    loader.deleteHistory()
+    shutil.rmtree(image_dir, ignore_errors=True)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Loader on synthetic images")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1024, 2048, 4096, 8192, 16384], help="Image sizes in pixels")
+    parser.add_argument("--repeats", type=int, default=5, help="Number of runs of the per-image stages")
+    parser.add_argument("--crops", type=int, default=200, help="Number of runs of the per-crop stages")
+    parser.add_argument("--lazy", action="store_true", help="Benchmark the memory-mapped image backend")
+    parser.add_argument("--output", default="benchmark_%s.json" % datetime.now().strftime("%Y%m%d%H%M%S"), help="JSON file of the results")
+    args = parser.parse_args()
+
+    options = {"lazy": args.lazy}
+    workdir = tempfile.mkdtemp(prefix="junction_benchmark_")
+    cwd = os.getcwd()
+    output = os.path.abspath(args.output)
+    results = []
+    try:
+        # The session history is written in the working directory
+        os.chdir(workdir)
+        for size in args.sizes:
+            for result in benchmark_size(size, args.repeats, args.crops, options, workdir):
+                print(f"{size:6d} px  {result['stage']:<15} p50 {result['p50_ms']:9.2f} ms  p90 {result['p90_ms']:9.2f} ms  "
+                      f"p99 {result['p99_ms']:9.2f} ms  peak {result['peak_mb']:8.1f} MB")
+                results.append(result)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    meta = {"date": datetime.now().isoformat(), "platform": platform.platform(), "python": platform.python_version(),
+            "numpy": np.__version__, "options": vars(args)}
+    with open(output, "w") as json_file:
+        json.dump({"meta": meta, "results": results}, json_file, indent=1)
+    print("Results saved to", output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+import numpy as np
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".junction_annotator_cache")
+# Increase when the preprocessing changes so that old entries are not used anymore
+CACHE_VERSION = 2
+ARRAY_NAMES = ("image", "foreground")
+
+
+class ImageCache:
+
+    def __init__(self, cache_dir, max_bytes=20*1024**3):
+        """
+        On-disk cache of preprocessed images stored as .npy files that are memory-mapped on load
+        :param cache_dir: Directory of the cache
+        :param max_bytes: Size of the cache above which the least recently used entries are removed
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, img_path, params):
+        """
+        Key of an image; changes with the file content and the preprocessing parameters
+        :param img_path: path of the source image
+        :param params: dict of the preprocessing parameters
+        """
+        stat = os.stat(img_path)
+        description = {"path": os.path.abspath(img_path), "mtime": stat.st_mtime_ns, "size": stat.st_size,
+                       "params": params, "version": CACHE_VERSION}
+        return hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def get(self, img_path, params, names=ARRAY_NAMES):
+        """
+        Load the cached arrays of an image
+        :param names: Names of the arrays to load
+        :return: Tuple of memory-mapped arrays, or None if the image is not cached
+        """
+        entry = os.path.join(self.cache_dir, self.key(img_path, params))
+        try:
+            arrays = tuple(np.load(os.path.join(entry, name+".npy"), mmap_mode='r') for name in names)
+        except (OSError, ValueError):
+            return None
+        os.utime(entry)  # Mark as recently used
+        return arrays
+
+    def put(self, img_path, params, arrays, names=ARRAY_NAMES):
+        """
+        Store the arrays of an image, then evict the least recently used entries
+        :param arrays: Tuple of arrays, in the order of names
+        :param names: Names of the arrays
+        """
+        entry = os.path.join(self.cache_dir, self.key(img_path, params))
+        tmp_entry = os.path.join(self.cache_dir, "tmp_" + uuid.uuid4().hex)
+        os.makedirs(tmp_entry)
+        try:
+            for name, array in zip(names, arrays):
+                np.save(os.path.join(tmp_entry, name+".npy"), array)
+            os.rename(tmp_entry, entry)
+        except OSError:
+            # Already stored by another thread or process
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits in max_bytes
+        """
+        with self.lock:
+            entries = []
+            for name in os.listdir(self.cache_dir):
+                entry = os.path.join(self.cache_dir, name)
+                if name.startswith("tmp_") or not os.path.isdir(entry):
+                    continue
+                size = sum(f.stat().st_size for f in os.scandir(entry))
+                entries.append((os.stat(entry).st_mtime, size, entry))
+            entries.sort()
+            total = sum(e[1] for e in entries)
+            for _, size, entry in entries:
+                if total <= self.max_bytes:
+                    break
+                shutil.rmtree(entry, ignore_errors=True)
+                total -= size
@@ -0,0 +1,118 @@
+import os
+import numpy as np
+
+CROP_DTYPE = np.dtype([("Y", "int32"), ("X", "int32"), ("size", "int32")])
+
+
+class CropTable:
+
+    def __init__(self, image, positions=None, size=64):
+        """
+        Crops of one image stored as a structured array, with the path of the image stored once.
+        Indexing returns the same dict as the former list of crops: {'image', 'X', 'Y', 'size'}
+        :param image: path of the image
+        :param positions: Array with shape [n_crops, 2] of the Y, X position of the crops
+        :param size: Size of the crops
+        """
+        self.image = image
+        if positions is None:
+            positions = np.zeros((0, 2), dtype='int32')
+        self.array = np.empty(len(positions), dtype=CROP_DTYPE)
+        self.array["Y"] = positions[:, 0]
+        self.array["X"] = positions[:, 1]
+        self.array["size"] = size
+        # Incremented when the order of the crops changes
+        self.version = 0
+
+    @classmethod
+    def from_array(cls, image, array):
+        table = cls(image)
+        table.array = np.asarray(array, dtype=CROP_DTYPE)
+        return table
+
+    @classmethod
+    def from_dicts(cls, crops):
+        """
+        Convert a list of crop dicts, as saved in the history of older versions
+        """
+        image = crops[0]["image"] if crops else None
+        array = np.array([(crop["Y"], crop["X"], crop["size"]) for crop in crops], dtype=CROP_DTYPE)
+        return cls.from_array(image, array)
+
+    def __len__(self):
+        return len(self.array)
+
+    def __getitem__(self, idx):
+        row = self.array[idx]
+        return {"image": self.image, "X": int(row["X"]), "Y": int(row["Y"]), "size": int(row["size"])}
+
+    def __iter__(self):
+        for idx in range(len(self.array)):
+            yield self[idx]
+
+    def subset(self, start, stop):
+        """
+        Crops from start to stop, as a new table
+        """
+        return CropTable.from_array(self.image, self.array[start:stop])
+
+    def exclude(self, keys):
+        """
+        Remove the crops whose key is in keys
+        :param keys: Sorted int64 keys, see keys()
+        :return: Number of crops removed
+        """
+        done = np.isin(self.keys(), keys, assume_unique=True)
+        self.array = self.array[~done]
+        self.version += 1
+        return int(done.sum())
+
+    def shuffle(self, rng):
+        """
+        Shuffle the crops in place
+        :param rng: numpy Generator, seeded for a reproducible order
+        """
+        self.array = self.array[rng.permutation(len(self.array))]
+        self.version += 1
+
+    def keys(self):
+        """
+        Unique int64 key of each crop, built from its position
+        """
+        return (self.array["Y"].astype('int64') << 32) | self.array["X"].astype('int64')
+
+    def reorder(self, start, keys, scores):
+        """
+        Sort the crops from start onwards by decreasing score; crops without a score go last
+        :param start: Index of the first crop to sort; the crops before it keep their place
+        :param keys: Keys of the scored crops, see keys()
+        :param scores: Scores of the crops
+        """
+        order = np.argsort(keys)
+        keys, scores = keys[order], scores[order]
+        tail_keys = self.keys()[start:]
+        idx = np.clip(np.searchsorted(keys, tail_keys), 0, max(len(keys) - 1, 0))
+        tail_scores = np.full(len(tail_keys), -np.inf, dtype='float32')
+        if len(keys):
+            found = keys[idx] == tail_keys
+            tail_scores[found] = scores[idx[found]]
+        # A new array, the previous one may be being saved by the writer thread
+        self.array = np.concatenate((self.array[:start], self.array[start:][np.argsort(-tail_scores, kind='stable')]))
+        self.version += 1
+
+    def save(self, fname):
+        """
+        Write the crops atomically to a .npz file, and wait until it is on the disk
+        """
+        tmp_file = fname + ".tmp"
+        with open(tmp_file, "wb") as file_object:
+            np.savez(file_object, crops=self.array, image=np.array(self.image if self.image is not None else ""))
+            file_object.flush()
+            os.fsync(file_object.fileno())
+        os.replace(tmp_file, fname)
+
+    @classmethod
+    def load(cls, fname):
+        with np.load(fname) as data:
+            image = str(data["image"]) or None
+            return cls.from_array(image, data["crops"])
@@ -0,0 +1,215 @@
+"""
+Export the annotated crops of an output directory as shards of stacked uint8 crops and label arrays,
+ready to be memory-mapped for training. Each source image is read once, by one worker process
+
+Usage: python export.py <output directory> <export directory> [--incremental] [--shard-size N]
+
+Files written in the export directory:
+    crops_XXXXX.npy    uint8 array with shape [n, total_size, total_size, color]
+    labels_XXXXX.npy   structured array with the source, position, structure, classes and ambiguous flags of the crops
+    index.json         list of the shards, their number of crops and their source images
+    exported.txt       patch list lines already exported, used by --incremental
+
+With --incremental, a crop annotated again since the last export is not exported twice: its row in the
+labels of the shard that holds it is updated to the new annotation
+"""
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import collections
+import itertools
+import json
+import os
+import numpy as np
+from loader import Loader
+from crops import CropTable
+from annotations import read_records, latest_lines, record_key
+from cache import DEFAULT_CACHE_DIR
+
+INDEX_F_NAME = "index.json"
+EXPORTED_F_NAME = "exported.txt"
+# Number of images per worker whose crops are extracted ahead of the shard writer
+IMAGES_IN_FLIGHT = 2
+LABEL_DTYPE = np.dtype([("image_idx", "int32"), ("X", "int32"), ("Y", "int32"), ("size", "int32"), ("structure", "int8"),
+                        ("classes", "float32", (4,)), ("ambiguous", "bool", (4,))])
+
+
+def extract_crops(img_path, records, options):
+    """
+    Extract the crops of the records of one image
+    :param img_path: path of the source image
+    :param records: List of records of the image, see annotations.parse_record
+    :param options: dict of Loader arguments
+    :return: uint8 array with shape [n, total_size, total_size, color]
+    """
+    loader = Loader(path=os.path.dirname(img_path), prefetch=0, **options)
+    loader.load_image(img_path)
+    loader.crop_data = CropTable.from_dicts(records)
+    return loader.get_batch(range(len(records)))
+
+
+class ShardWriter:
+
+    def __init__(self, export_path, shard_size):
+        """
+        Write crops and labels to fixed-size shards. New shards are numbered after the shards
+        already listed in the index of the export directory
+        :param export_path: Export directory
+        :param shard_size: Number of crops per shard
+        """
+        self.export_path = export_path
+        self.shard_size = shard_size
+        self.index_file = os.path.join(export_path, INDEX_F_NAME)
+        self.exported_file = os.path.join(export_path, EXPORTED_F_NAME)
+        self.index = {"shards": []}
+        if os.path.exists(self.index_file):
+            with open(self.index_file) as json_file:
+                self.index = json.load(json_file)
+        self.crops = []
+        self.records = []
+        self.lines = []
+
+    def add(self, crops, records, lines):
+        """
+        Add the crops of an image
+        :param crops: Array of crops
+        :param records: Records of the crops, see annotations.parse_record
+        :param lines: Patch list lines of the records
+        """
+        self.crops.extend(crops)
+        self.records.extend(records)
+        self.lines.extend(lines)
+        while len(self.crops) >= self.shard_size:
+            self.write_shard(self.shard_size)
+
+    def write_shard(self, n):
+        """
+        Write the first n pending crops to a new shard, then mark their records as exported
+        """
+        shard_idx = len(self.index["shards"])
+        crops_name, labels_name = "crops_%05d.npy" % shard_idx, "labels_%05d.npy" % shard_idx
+
+        crops = np.lib.format.open_memmap(os.path.join(self.export_path, crops_name), mode="w+", dtype="uint8",
+                                          shape=(n,) + self.crops[0].shape)
+        for i in range(n):
+            crops[i] = self.crops[i]
+        crops.flush()
+        del crops
+
+        images = sorted(set(record["image"] for record in self.records[:n]))
+        image_idx = {image: i for i, image in enumerate(images)}
+        labels = np.zeros(n, dtype=LABEL_DTYPE)
+        for i, record in enumerate(self.records[:n]):
+            labels[i] = (image_idx[record["image"]], record["X"], record["Y"], record["size"], record["structure"],
+                         record["classes"], record["ambiguous"])
+        np.save(os.path.join(self.export_path, labels_name), labels)
+
+        self.index["shards"].append({"crops": crops_name, "labels": labels_name, "n": n, "images": images})
+        tmp_file = self.index_file + ".tmp"
+        with open(tmp_file, "w") as json_file:
+            json.dump(self.index, json_file, indent=1)
+        os.replace(tmp_file, self.index_file)
+        with open(self.exported_file, "a") as file_object:
+            file_object.writelines(self.lines[:n])
+
+        self.crops, self.records, self.lines = self.crops[n:], self.records[n:], self.lines[n:]
+
+    def update_labels(self, records, lines):
+        """
+        Replace the labels of crops already exported with new annotations of the same crops, then
+        mark the new records as exported
+        :param records: Records of the crops, see annotations.parse_record
+        :param lines: Patch list lines of the records
+        """
+        updates = {(record["image"], record["X"], record["Y"]): record for record in records}
+        for shard in self.index["shards"]:
+            labels_file = os.path.join(self.export_path, shard["labels"])
+            labels = np.load(labels_file)
+            changed = False
+            for i, label in enumerate(labels):
+                record = updates.get((shard["images"][label["image_idx"]], int(label["X"]), int(label["Y"])))
+                if record is not None:
+                    labels[i] = (label["image_idx"], record["X"], record["Y"], record["size"], record["structure"],
+                                 record["classes"], record["ambiguous"])
+                    changed = True
+            if changed:
+                # Replaced at once so that a reader never sees a partly written file
+                tmp_file = labels_file + ".tmp.npy"
+                np.save(tmp_file, labels)
+                os.replace(tmp_file, labels_file)
+        with open(self.exported_file, "a") as file_object:
+            file_object.writelines(lines)
+
+    def close(self):
+        if self.crops:
+            self.write_shard(len(self.crops))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the annotated crops as sharded numpy arrays")
+    parser.add_argument("outputpath", help="Output directory of the annotator, containing patchlist.txt")
+    parser.add_argument("export_path", help="Directory of the shards")
+    parser.add_argument("--incremental", action="store_true", help="Only export the annotations added since the last export")
+    parser.add_argument("--shard-size", type=int, default=4096, help="Number of crops per shard")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of worker processes")
+    parser.add_argument("--crop-size", type=int, default=64)
+    parser.add_argument("--total-size", type=int, default=128)
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR, help="Cache of preprocessed images")
+    parser.add_argument("--lazy", action=argparse.BooleanOptionalAction, default=True,
+                        help="Memory-map the images, as the annotator does with LAZY_LOADING")
+    args = parser.parse_args()
+    os.makedirs(args.export_path, exist_ok=True)
+
+    # Latest exported line of each crop
+    exported = {}
+    exported_file = os.path.join(args.export_path, EXPORTED_F_NAME)
+    if args.incremental:
+        exported = latest_lines([exported_file])
+    else:
+        for fname in os.listdir(args.export_path):
+            if fname in (INDEX_F_NAME, EXPORTED_F_NAME) or fname.startswith(("crops_", "labels_")):
+                os.remove(os.path.join(args.export_path, fname))
+
+    # Group the records of the crops not exported yet by source image; the crops exported with an
+    # older annotation only get their labels updated
+    groups = {}
+    updated = []
+    for line, record in read_records(args.outputpath):
+        exported_line = exported.get(record_key(line))
+        if exported_line is None:
+            groups.setdefault(record["image"], []).append((line, record))
+        elif exported_line != line:
+            updated.append((line, record))
+    print(f"Exporting {sum(len(group) for group in groups.values())} crops from {len(groups)} images")
+
+    options = {"crop_size": args.crop_size, "total_size": args.total_size, "cache_dir": args.cache_dir, "lazy": args.lazy}
+    writer = ShardWriter(args.export_path, args.shard_size)
+    if updated:
+        print(f"Updating the labels of {len(updated)} crops annotated again")
+        writer.update_labels([record for _, record in updated], [line for line, _ in updated])
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        # Images are submitted as results are written, so that the crops held in memory do not grow
+        # with the size of the export
+        pending = collections.deque()
+        jobs = iter(groups.items())
+        while True:
+            for img_path, group in itertools.islice(jobs, IMAGES_IN_FLIGHT*args.workers - len(pending)):
+                pending.append((group, executor.submit(extract_crops, img_path, [record for _, record in group], options)))
+            if not pending:
+                break
+            group, future = pending.popleft()
+            try:
+                crops = future.result()
+            except Exception as e:
+                print(f"{group[0][1]['image']}\tfailed: {e}")
+                continue
+            finally:
+                del future
+            writer.add(crops, [record for _, record in group], [line for line, _ in group])
+            del crops
+        writer.close()
+
+    print(f"{len(writer.index['shards'])} shards in {args.export_path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+import glob
+import json
+import os
+import uuid
+from crops import CropTable
+
+HISTORY_F_NAME = "history.json"
+JOURNAL_F_NAME = "history.journal"
+CROPS_F_NAME = "history_crops.npz"
+CHECKPOINT_EVERY = 200
+
+
+class SessionJournal:
+
+    def __init__(self, checkpoint_file=HISTORY_F_NAME, journal_file=JOURNAL_F_NAME, crops_file=CROPS_F_NAME,
+                 checkpoint_every=CHECKPOINT_EVERY):
+        """
+        Session history stored as a checkpoint and an append-only journal of the changes since the
+        checkpoint. The checkpoint holds the full state (files, crop data, ...) and is only
+        rewritten when the crop data changes or every checkpoint_every saves; other saves append
+        one line to the journal. The crop table of each checkpoint is stored in its own binary file,
+        named after the checkpoint and referenced by the JSON file, so that replacing the JSON file
+        switches to the new crop table at once
+        :param checkpoint_file: JSON file of the checkpoint
+        :param journal_file: JSON lines file of the journal
+        :param crops_file: .npz file name from which the names of the crop tables of the checkpoints are made
+        :param checkpoint_every: Number of journal records after which a new checkpoint is written
+        """
+        self.checkpoint_file = checkpoint_file
+        self.journal_file = journal_file
+        self.crops_file = crops_file
+        self.checkpoint_every = checkpoint_every
+
+        # Ids restart with each session, the token keeps the crop table names unique
+        self.session = uuid.uuid4().hex[:8]
+        self.checkpoint_id = None
+        self.checkpoint_files = None
+        self.checkpoint_file_idx = None
+        self.checkpoint_crops_version = None
+        self.checkpoint_block = None
+        self.n_records = 0
+        self.size = 0
+        self.file_object = None
+
+    def save(self, state, classes, structures, ambiguous):
+        """
+        Save the state of the session
+        :param state: dict with the path, outputpath, files, file_idx, crop_data, n, n_shown and block of the loader
+        :param classes, structures, ambiguous: Annotation history of the session
+        """
+        if (self.checkpoint_id is None or self.n_records >= self.checkpoint_every
+                or state["file_idx"] != self.checkpoint_file_idx or len(state["files"]) != self.checkpoint_files
+                or getattr(state["crop_data"], "version", None) != self.checkpoint_crops_version
+                or state.get("block") != self.checkpoint_block):
+            self.checkpoint(state, classes, structures, ambiguous)
+            return
+
+        size = len(classes)
+        start = min(self.size, size)
+        record = {"id": self.checkpoint_id, "file_idx": state["file_idx"], "n": state["n"], "n_shown": state.get("n_shown"), "size": size,
+                  "tail": [[classes[k], structures[k], ambiguous[k]] for k in range(start, size)]}
+        if self.file_object is None:
+            self.file_object = open(self.journal_file, "a")
+        self.file_object.write(json.dumps(record) + "\n")
+        self.n_records += 1
+        self.size = size
+
+    def checkpoint(self, state, classes, structures, ambiguous):
+        """
+        Write the full state atomically and start a new journal
+        """
+        self.checkpoint_id = 0 if self.checkpoint_id is None else self.checkpoint_id + 1
+        data = dict(state, classes=classes, structures=structures, ambiguous=ambiguous, id=self.checkpoint_id)
+        crops_file = None
+        if isinstance(data.get("crop_data"), CropTable):
+            stem, ext = os.path.splitext(self.crops_file)
+            crops_file = "%s_%s_%d%s" % (stem, self.session, self.checkpoint_id, ext)
+            data["crop_data"].save(crops_file)
+            data["crop_data"] = {"file": crops_file}
+
+        tmp_file = self.checkpoint_file + ".tmp"
+        with open(tmp_file, "w") as f_ow:
+            json.dump(data, f_ow)
+            f_ow.flush()
+            os.fsync(f_ow.fileno())
+        os.replace(tmp_file, self.checkpoint_file)
+        self.remove_crops_files(keep=crops_file)
+
+        # Records of the previous checkpoint are ignored because of their id
+        self.close()
+        self.file_object = open(self.journal_file, "w")
+        self.checkpoint_files = len(state["files"])
+        self.checkpoint_file_idx = state["file_idx"]
+        self.checkpoint_crops_version = getattr(state["crop_data"], "version", None)
+        self.checkpoint_block = state.get("block")
+        self.n_records = 0
+        self.size = len(classes)
+
+    def flush(self, fsync=False):
+        """
+        Write the buffered records to the journal
+        :param fsync: Also wait until the journal is on the disk
+        """
+        if self.file_object is not None:
+            self.file_object.flush()
+            if fsync:
+                os.fsync(self.file_object.fileno())
+
+    def load(self):
+        """
+        Read the checkpoint and replay the journal
+        :return: dict of the saved state, or None if there is no checkpoint
+        """
+        if not os.path.exists(self.checkpoint_file):
+            return None
+        with open(self.checkpoint_file) as json_file:
+            data = json.load(json_file)
+
+        crop_data = data.get("crop_data")
+        if isinstance(crop_data, dict):
+            data["crop_data"] = CropTable.load(crop_data["file"])
+        elif isinstance(crop_data, list):
+            # History written before the crop table
+            data["crop_data"] = CropTable.from_dicts(crop_data)
+
+        if os.path.exists(self.journal_file):
+            with open(self.journal_file) as journal:
+                for line in journal:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Line cut by a crash
+                        break
+                    if record.get("id") != data.get("id"):
+                        continue
+                    data["file_idx"] = record["file_idx"]
+                    data["n"] = record["n"]
+                    data["n_shown"] = record.get("n_shown")
+                    keep = record["size"] - len(record["tail"])
+                    for i, key in enumerate(("classes", "structures", "ambiguous")):
+                        data[key] = data[key][:keep] + [entry[i] for entry in record["tail"]]
+        return data
+
+    def remove_crops_files(self, keep=None):
+        """
+        Remove the crop tables of the previous checkpoints
+        :param keep: Crop table of the current checkpoint
+        """
+        stem, ext = os.path.splitext(self.crops_file)
+        # The crop table of the first versions had no checkpoint name
+        for fname in glob.glob(glob.escape(stem) + "_*" + ext) + [self.crops_file]:
+            if fname != keep and os.path.exists(fname):
+                os.remove(fname)
+
+    def delete(self):
+        self.close()
+        for fname in (self.checkpoint_file, self.journal_file):
+            if os.path.exists(fname):
+                os.remove(fname)
+        self.remove_crops_files()
+        self.checkpoint_id = None
+
+    def close(self):
+        if self.file_object is not None:
+            self.file_object.close()
+            self.file_object = None
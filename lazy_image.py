@@ -0,0 +1,133 @@
+from skimage.filters import gaussian
+from scipy.ndimage.morphology import binary_fill_holes
+import numpy as np
+import os
+
+# Number of pixels processed at once when scanning a whole image
+CHUNK_PIXELS = 8*1024**2
+# Rows needed on each side of a chunk so that gaussian(sigma=5) gives the same result as on the whole image
+GAUSSIAN_HALO = 21
+
+
+def open_memmap(img_path):
+    """
+    Memory-map an image without reading it
+    :param img_path: path of an uncompressed TIFF or of a .npy file with shape [channel, height, width]
+    :return: Memory-mapped array, or None if the file cannot be memory-mapped
+    """
+    ext = os.path.splitext(img_path)[1].lower()
+    try:
+        if ext == ".npy":
+            data = np.load(img_path, mmap_mode='r')
+        elif ext in (".tif", ".tiff"):
+            import tifffile
+            data = tifffile.memmap(img_path, mode='r')
+        else:
+            return None
+    except (ImportError, OSError, ValueError):
+        return None
+    if data.ndim != 3 or data.shape[0] < 2:
+        return None
+    return data
+
+
+def read_shape(img_path):
+    """
+    Shape of an image read from the header of the file, without reading the pixels
+    :param img_path: path of a TIFF or .npy image
+    :return: Shape of the image, or None if it cannot be read from the header
+    """
+    ext = os.path.splitext(img_path)[1].lower()
+    try:
+        if ext == ".npy":
+            return np.load(img_path, mmap_mode='r').shape
+        elif ext in (".tif", ".tiff"):
+            import tifffile
+            with tifffile.TiffFile(img_path) as tif:
+                return tif.series[0].shape
+    except (ImportError, OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+class LazyImage:
+
+    def __init__(self, data, pad_size, crop_size, bounds=None):
+        """
+        Padded uint8 RGB view of a memory-mapped image. Slicing it reads and normalizes only the
+        requested region, the same way Loader.preprocess_image does on the whole image
+        :param data: Memory-mapped array with shape [channel, height, width]
+        :param pad_size: Padding on the top and left borders
+        :param crop_size: Additional padding on the bottom and right borders
+        :param bounds: Array with shape [2, 2] of the min and max of the first two channels, as given by
+                       the bounds attribute; None reads the whole image to compute them
+        """
+        self.data = data
+        self.pad_size = pad_size
+        self.height, self.width = data.shape[1:]
+        self.shape = (self.height + 2*pad_size + crop_size, self.width + 2*pad_size + crop_size, 3)
+        self.ndim = 3
+        self.dtype = np.dtype('uint8')
+
+        if bounds is None:
+            self.min = np.full(2, np.inf, dtype='float32')
+            self.max = np.full(2, -np.inf, dtype='float32')
+            for rows in self.row_chunks():
+                chunk = self.data[:2, rows].astype('float32')
+                self.min = np.minimum(self.min, chunk.min(axis=(1, 2)))
+                self.max = np.maximum(self.max, chunk.max(axis=(1, 2)))
+        else:
+            self.min, self.max = np.asarray(bounds, dtype='float32')
+        self.bounds = np.stack((self.min, self.max))
+        self.range = self.max - self.min
+
+    def row_chunks(self):
+        """
+        Split the rows of the image in chunks of about CHUNK_PIXELS pixels
+        :return: Iterator of slices
+        """
+        step = max(1, CHUNK_PIXELS // max(1, self.width))
+        for start in range(0, self.height, step):
+            yield slice(start, min(self.height, start + step))
+
+    def __getitem__(self, key):
+        rows, cols = key[:2]
+        y0, y1, _ = rows.indices(self.shape[0])
+        x0, x1, _ = cols.indices(self.shape[1])
+        region = np.zeros((max(0, y1 - y0), max(0, x1 - x0), 3), dtype='uint8')
+
+        # Intersection of the region with the image, in image coordinates
+        sy0, sy1 = max(y0 - self.pad_size, 0), min(y1 - self.pad_size, self.height)
+        sx0, sx1 = max(x0 - self.pad_size, 0), min(x1 - self.pad_size, self.width)
+        if sy0 >= sy1 or sx0 >= sx1:
+            return region
+
+        src = self.data[:2, sy0:sy1, sx0:sx1].astype('float32')
+        src = src - self.min[:, None, None]
+        src = src / self.range[:, None, None]
+        src = np.clip(src, 0, 1)
+        src = (src*255).astype('uint8')
+
+        dy, dx = sy0 + self.pad_size - y0, sx0 + self.pad_size - x0
+        # Channels are swapped as in Loader.preprocess_image
+        region[dy:dy+sy1-sy0, dx:dx+sx1-sx0, 0] = src[1]
+        region[dy:dy+sy1-sy0, dx:dx+sx1-sx0, 1] = src[0]
+        return region
+
+    def foreground(self):
+        """
+        Vague segmentation of the foreground, computed chunk by chunk on the second channel
+        :return: Boolean foreground mask with shape [height, width]
+        """
+        total = 0.
+        for rows in self.row_chunks():
+            total += np.sum(self.data[1, rows], dtype='float64')
+        threshold = total / (self.height * self.width) * 0.75
+
+        background = np.empty((self.height, self.width), dtype='bool')
+        for rows in self.row_chunks():
+            start, stop = max(0, rows.start - GAUSSIAN_HALO), min(self.height, rows.stop + GAUSSIAN_HALO)
+            chunk = gaussian(self.data[1, start:stop].astype('float32') < threshold, 5) > 0.3
+            # Keep only the rows of the chunk that are not part of the halo
+            background[rows] = chunk[rows.start - start:rows.stop - start]
+        return binary_fill_holes(~background)
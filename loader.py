@@ -1,17 +1,35 @@
 from skimage import io
-from skimage.filters import gaussian, rank
+from skimage.filters import gaussian
 from scipy.ndimage.morphology import binary_fill_holes
+from scipy.ndimage import minimum_filter
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 import os
-import json
+import zlib
 from datetime import datetime
-
-HISTORY_F_NAME= "history.json"
-OUTPUT_FILE_NAME="patchlist.txt"
+from concurrent.futures import ThreadPoolExecutor
+from prefetch import Prefetcher
+from cache import ImageCache
+from lazy_image import LazyImage, open_memmap, read_shape
+from crops import CropTable
+from ranking import ActiveLearningRanker
+from prediction import CropPredictor
+from model import CropModel, crop_features
+from annotations import open_annotations, annotations_exist, annotated_crops_index, OUTPUT_FILE_NAME
+from journal import SessionJournal, HISTORY_F_NAME
+from workqueue import WorkQueue
+from watcher import DirectoryWatcher, list_images, is_image_file
+from writer import BackgroundWriter, FLUSH_STAGE
+import timing
 
 class Loader:
     
-    def __init__(self, path, outputpath=None, crop_size=64, crop_step=int(64*0.75), total_size=128, fg_threshold=0.2):
+    def __init__(self, path, outputpath=None, crop_size=64, crop_step=int(64*0.75), total_size=128, fg_threshold=0.1,
+                 prefetch=1, prefetch_memory=2*1024**3, cache_dir=None, cache_size=20*1024**3,
+                 edge_band=300, lazy=False, annotation_backend="text", seed=None,
+                 ordering="random", refit_every=20, prefill=False, annotator=None,
+                 watch=False, watch_interval=5., background_writes=False,
+                 skip_annotated=False, include_archives=False):
         """
         Crop iterator
         :param path:
@@ -19,69 +37,446 @@ class Loader:
         :param crop_step: Step between crops; smaller step means larger overlap between crops
         :param total_size: Size of the larger crop for vizualisation
         :param fg_threshold: Proportion of the crop that must be foreground to be considered
+        :param prefetch: Number of upcoming files prepared in the background; 0 disables prefetching
+        :param prefetch_memory: Maximum number of bytes held by prefetched images
+        :param cache_dir: Directory where preprocessed images are cached between sessions; None disables the cache
+        :param cache_size: Maximum size of the cache in bytes
+        :param edge_band: Thickness in pixels of the foreground edges kept by load_image(edges=True)
+        :param lazy: Memory-map uncompressed TIFF and .npy images and read only the crops that are displayed
+        :param annotation_backend: "text" to log the annotations to the patch list or "sqlite" to store them in an indexed database
+        :param seed: Seed of the shuffling of the crops; None gives a different order for every session
+        :param ordering: "random" to show the crops in random order or "active" to show first the crops
+                         that a model trained on the annotations of the output directory is the least sure of
+        :param refit_every: Number of annotations after which the "active" ordering is updated
+        :param prefill: Predict the annotation of the upcoming crops from the annotations of the output directory
+        :param annotator: Name of the annotator to share the work with other annotators of the same output
+                          directory: the crops are claimed by blocks from a common queue and each annotator
+                          writes to their own patch list file
+        :param watch: Keep watching the directory and add the images that appear to the end of the work queue
+        :param watch_interval: Time between two checks of the directory in seconds
+        :param background_writes: Write the annotations and the history in a dedicated thread, committed by groups
+        :param skip_annotated: Leave out the crops already annotated in the output directory
+        :param include_archives: With skip_annotated, also leave out the crops of the archived patch lists
         """
         self.path = path
         self.outputpath= outputpath
-        self.files = os.listdir(path)
+        self.files = list_images(path, lazy)
 
         self.crop_size = crop_size
         self.crop_step = crop_step
         self.total_size = total_size
 
         self.fg_threshold = fg_threshold
+        self.edge_band_size = edge_band
+        self.lazy = lazy
+        self.rng = np.random.default_rng(seed)
 
         self.file_idx = 0
         self.n = 0
+        # Number of crops of crop_data shown so far; n is lower after going back
+        self.n_shown = 0
         self.previous= 0
         self.atStopIteration = False
 
-        self.generate_crops(os.path.join(self.path, self.files[self.file_idx]))
-
+        self.history = SessionJournal()
+        self.writer = None
+        if background_writes:
+            self.writer = BackgroundWriter(self.commit)
+
+        self.annotations = None
+        if outputpath is not None:
+            self.annotations = open_annotations(outputpath, annotation_backend, annotator)
+
+        # Keys of the crops annotated before the session, by image file name. Built with the first crops,
+        # after the patch list may have been archived
+        self.skip_annotated = skip_annotated and outputpath is not None
+        self.include_archives = include_archives
+        self.annotated = None
+
+        # Shared work queue, image name and index of the block of crops being annotated, and crops of its image
+        self.queue = None
+        self.block = None
+        self.image_crops = None
+        if annotator is not None and outputpath is not None:
+            self.queue = WorkQueue(outputpath, annotator)
+
+        self.cache = None
+        if cache_dir is not None:
+            self.cache = ImageCache(cache_dir, max_bytes=cache_size)
+
+        self.prefetcher = None
+        if prefetch > 0:
+            self.prefetcher = Prefetcher(self.prepare_image, n_files=prefetch, max_bytes=prefetch_memory,
+                                         size_fn=self.prepared_bytes)
+
+        # Model of the annotations used by the active ordering and the prefill, updated in a background worker
+        self.model = None
+        self.model_worker = None
+        self.prediction_worker = None
+        self.ranker = None
+        self.predictor = None
+        if ordering == "active" or prefill:
+            pad_size = (total_size - crop_size)//2
+            self.model = CropModel()
+            self.model_worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix="model")
+            if outputpath is not None:
+                self.model_worker.submit(self.model.bootstrap, outputpath, self.open_image, pad_size, crop_size)
+            if ordering == "active":
+                self.ranker = ActiveLearningRanker(self.model, self.model_worker, pad_size, crop_size, refit_every=refit_every)
+            if prefill:
+                # Predictions have their own worker so that they do not wait behind the bootstrap or a ranking
+                self.prediction_worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prediction")
+                self.predictor = CropPredictor(self.model, self.prediction_worker, pad_size, crop_size)
+
+        # The watcher starts with the first crop request, once the files of a resumed session are known
+        self.watch = watch
+        self.watch_interval = watch_interval
+        self.watcher = None
+
+        # Nothing is loaded until the first crop is requested
+        self.crop_data = None
+        self.image_path = None
+
+    def ensure_loaded(self):
+        """
+        Load the current file if it is not loaded yet, generating its crops unless they were restored from history
+        """
+        img_path = os.path.join(self.path, self.files[self.file_idx])
+        if self.image_path == img_path:
+            return
+        if self.crop_data is None or self.crop_data.image != img_path:
+            # Also the case of the crops of the previous file, when files were added after the end of the queue
+            self.n = 0
+            self.generate_crops(img_path)
+        else:
+            self.load_image(img_path)
+            self.prefetch_next()
+            if self.ranker is not None:
+                self.ranker.schedule(self.image_pad, self.crop_data)
+            if self.predictor is not None:
+                self.predictor.schedule(self.image_pad, self.crop_data, self.n)
+
+    @timing.timed("load_image")
     def load_image(self, img_path, edges=False):
         """
-        Load the image of the given index, turns it into uint8 RGB for display
-        :param file_idx: index of the image in self.files
-        :return: Image with shape [height, width, color]
+        Load the image of the given path, turns it into uint8 RGB for display. A prefetched
+        result is used when the background worker already prepared this image
+        :param img_path: path of the image
         """
-        self.image = io.imread(img_path).astype('float32')
+        data = None
+        if self.prefetcher is not None and not edges:
+            data = self.prefetcher.get(img_path)
+        if data is None:
+            data = self.prepare_image(img_path, edges)
+        self.image_pad, self.foreground = data
+        self.image_path = img_path
 
-        # Get a vague segmentation of the foreground
-        background = self.image[1]
-        background = background < np.mean(background)*0.75
-        background = gaussian(background, 5) > 0.3
-        foreground = binary_fill_holes(1 - background)
+        pad_size = (self.total_size - self.crop_size)//2
+        h, w = self.foreground.shape
+        if isinstance(self.image_pad, LazyImage):
+            # Lazy images are only read crop by crop
+            self.image = None
+        else:
+            self.image = self.image_pad[pad_size:pad_size+h, pad_size:pad_size+w]
+
+    def prepare_image(self, img_path, edges=False):
+        """
+        Get the preprocessed image from the cache, or preprocess it and store it in the cache
+        :param img_path: path of the image
+        :param edges: Keep only the edges of the foreground
+        :return: Padded image with shape [height, width, color] and foreground mask
+        """
+        if self.lazy:
+            data = open_memmap(img_path)
+            if data is not None:
+                return self.prepare_lazy_image(img_path, data, edges)
+
+        if self.cache is None:
+            return self.preprocess_image(img_path, edges)
 
-        # Get the difference of the foreground and an eroded foreground as edge (takes a while)
+        params = {"crop_size": self.crop_size, "total_size": self.total_size, "edges": edges}
         if edges:
-            foreground_erode = rank.minimum((foreground * 1).astype('uint8'), np.ones((300, 300)))  # Here we can vary the thickness of the edges with the shape of the np.ones
-            foreground = foreground - foreground_erode
+            params["edge_band"] = self.edge_band_size
+        data = self.cache.get(img_path, params)
+        if data is None:
+            data = self.preprocess_image(img_path, edges)
+            self.cache.put(img_path, params, data)
+        return data
+
+    def prepared_bytes(self, img_path):
+        """
+        Estimate of the memory held by the result of prepare_image, from the shape in the header of
+        the file. A cached image is memory-mapped but is counted all the same
+        :param img_path: path of the image
+        :return: Number of bytes
+        """
+        shape = read_shape(img_path)
+        if shape is None:
+            # Unknown format; the decoded image is at least as large as the file
+            return os.path.getsize(img_path)
+        h, w = shape[-2:]
+        if self.lazy and open_memmap(img_path) is not None:
+            # Only the foreground mask is in memory
+            return h*w
+        pad_size = (self.total_size - self.crop_size)//2
+        return (h + 2*pad_size + self.crop_size)*(w + 2*pad_size + self.crop_size)*3 + h*w
+
+    def prepare_lazy_image(self, img_path, data, edges=False):
+        """
+        Wrap a memory-mapped image in a LazyImage and get its foreground, from the cache if possible.
+        Only the foreground mask is held in memory. The cache also stores the min/max of the channels,
+        so that a cached image is not read in full
+        :param img_path: path of the image
+        :param data: Memory-mapped array with shape [channel, height, width]
+        :param edges: Keep only the edges of the foreground
+        :return: LazyImage and foreground mask
+        """
+        pad_size = (self.total_size - self.crop_size)//2
+        params = {"lazy": True, "edges": edges}
+        if edges:
+            params["edge_band"] = self.edge_band_size
+        names = ("foreground", "bounds")
+        cached = None
+        if self.cache is not None:
+            cached = self.cache.get(img_path, params, names=names)
+        if cached is not None:
+            foreground, bounds = cached
+            return LazyImage(data, pad_size, self.crop_size, bounds), foreground
+
+        with timing.stage("decode"):
+            image = LazyImage(data, pad_size, self.crop_size)
+        with timing.stage("mask"):
+            foreground = image.foreground()
+            if edges:
+                foreground = self.edge_band(foreground)
+        if self.cache is not None:
+            self.cache.put(img_path, params, (foreground, image.bounds), names=names)
+        return image, foreground
+
+    def preprocess_image(self, img_path, edges=False):
+        """
+        Read an image, segment its foreground and turn it into padded uint8 RGB. Does not
+        modify the loader so it can run in the prefetch worker
+        :param img_path: path of the image
+        :param edges: Keep only the edges of the foreground
+        :return: Padded image with shape [height, width, color] and foreground mask
+        """
+        with timing.stage("decode"):
+            image = io.imread(img_path).astype('float32')
+
+        # Get a vague segmentation of the foreground
+        with timing.stage("mask"):
+            background = image[1]
+            background = background < np.mean(background)*0.75
+            background = gaussian(background, 5) > 0.3
+            foreground = binary_fill_holes(1 - background)
+
+            # Get the difference of the foreground and an eroded foreground as edge
+            if edges:
+                foreground = self.edge_band(foreground)
+
+        with timing.stage("normalization"):
+            image_pad = self.to_rgb(image)
+
+        return image_pad, foreground
+
+    def to_rgb(self, image):
+        """
+        Normalize the first two channels of an image to uint8 and turn it into padded RGB
+        :param image: float32 image with shape [channel, height, width]; modified in place
+        :return: Padded image with shape [height, width, color]
+        """
+        image[0] = image[0] - np.min(image[0])
+        image[1] = image[1] - np.min(image[1])
+        image[0] = image[0] / np.max(image[0])
+        image[1] = image[1] / np.max(image[1])
+        image = np.clip(image, 0, 1)
+        image = (image*255).astype('uint8')
+
+        image = np.concatenate((image, np.zeros((1,image.shape[1], image.shape[2]), dtype='uint8')), axis=0)
+        image = np.moveaxis(image, 0, -1)
+        buffer = image[:,:,1].copy()
+        image[:,:,1] = image[:,:,0].copy()
+        image[:,:,0] = buffer
+
+        return self.pad_image(image)
+
+    def open_image(self, img_path):
+        """
+        Padded image to read crops from, without segmenting the foreground: a LazyImage when the
+        file can be memory-mapped, the cached image or else the whole image read from the file.
+        Nothing is written to the cache
+        :param img_path: path of the image
+        :return: Padded image with shape [height, width, color], or LazyImage
+        """
+        pad_size = (self.total_size - self.crop_size)//2
+        data = open_memmap(img_path)
+        if data is not None:
+            bounds = None
+            if self.cache is not None:
+                cached = self.cache.get(img_path, {"lazy": True, "edges": False}, names=("bounds",))
+                if cached is not None:
+                    bounds = cached[0]
+            return LazyImage(data, pad_size, self.crop_size, bounds)
+
+        if self.cache is not None:
+            cached = self.cache.get(img_path, {"crop_size": self.crop_size, "total_size": self.total_size, "edges": False},
+                                    names=("image",))
+            if cached is not None:
+                return cached[0]
+        return self.to_rgb(io.imread(img_path).astype('float32'))
+
+    def edge_band(self, foreground):
+        """
+        Keep the band of the foreground that disappears with an erosion by a square of side
+        edge_band. The square erosion is computed as two separable running minimums, which
+        runs in linear time whatever the thickness of the band
+        :param foreground: Boolean foreground mask
+        :return: Boolean mask of the edge band
+        """
+        foreground_erode = minimum_filter(foreground.view('uint8'), size=self.edge_band_size, mode='nearest')
+        return foreground & ~foreground_erode.view('bool')
 
-        self.foreground = foreground
+    def pad_image(self, image):
+        """
+        Pad the RGB image once so that every crop is a plain slice of the padded buffer.
+        The bottom and right borders get an extra crop_size of padding so that crops
+        touching the border keep the full total_size shape
+        :param image: Image with shape [height, width, color]
+        :return: Padded image
+        """
+        pad_size = (self.total_size - self.crop_size)//2
+        h, w = image.shape[:2]
+        image_pad = np.zeros((h + 2*pad_size + self.crop_size, w + 2*pad_size + self.crop_size, 3), dtype='uint8')
+        image_pad[pad_size:pad_size+h, pad_size:pad_size+w] = image
+        return image_pad
 
-        self.image[0] = self.image[0] - np.min(self.image[0])
-        self.image[1] = self.image[1] - np.min(self.image[1])
-        self.image[0] = self.image[0] / np.max(self.image[0])
-        self.image[1] = self.image[1] / np.max(self.image[1])
-        self.image = np.clip(self.image, 0, 1)
-        self.image = (self.image*255).astype('uint8')
+    def add_new_files(self):
+        """
+        Append the images found by the directory watcher to the work queue
+        """
+        if self.watch and self.watcher is None:
+            self.watcher = DirectoryWatcher(self.path, self.files, lazy=self.lazy, interval=self.watch_interval)
+        if self.watcher is not None:
+            self.files.extend(self.watcher.new_files())
 
-        self.image = np.concatenate((self.image, np.zeros((1,self.image.shape[1], self.image.shape[2]), dtype='uint8')), axis=0)
-        self.image = np.moveaxis(self.image, 0, -1)
-        buffer = self.image[:,:,1].copy()
-        self.image[:,:,1] = self.image[:,:,0].copy()
-        self.image[:,:,0] = buffer
+    def prefetch_next(self):
+        """
+        Ask the prefetch worker to prepare the files following the current one
+        """
+        if self.prefetcher is None:
+            return
+        upcoming = self.files[self.file_idx+1:self.file_idx+1+self.prefetcher.n_files]
+        self.prefetcher.schedule([os.path.join(self.path, f) for f in upcoming])
+
+    def close(self):
+        """
+        Stop the prefetch worker, release the prefetched images, finish the pending writes, compact
+        the patch list and write the timing report when the instrumentation is enabled
+        """
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+        if self.watcher is not None:
+            self.watcher.close()
+        if self.model_worker is not None:
+            # A running bootstrap or ranking cannot be cancelled, it is asked to stop
+            self.model.stop()
+            self.model_worker.shutdown(wait=False, cancel_futures=True)
+        if self.prediction_worker is not None:
+            self.prediction_worker.shutdown(wait=False, cancel_futures=True)
+        # The annotations of the current block are written before the block is released
+        if self.writer is not None:
+            self.writer.close()
+        if self.queue is not None:
+            self.queue.close()
+        if self.annotations is not None:
+            self.annotations.compact()
+            self.annotations.close()
+        self.history.close()
+        timing.dump_report(self.outputpath)
 
     def generate_crops(self, img_path):
         self.load_image(img_path)
-        self.crop_data = []
-        for j in range(0, self.image.shape[0], self.crop_step):
-            for i in range(0, self.image.shape[1], self.crop_step):
-                # Check if crop contains significant foreground
-                crop = self.foreground[j:j+self.crop_size, i:i+self.crop_size]
-                if np.sum(crop) >= np.size(crop) * 0.10:
-                    self.crop_data.append({'image':img_path, 'Y':j, 'X':i, 'size':self.crop_size})
+        self.prefetch_next()
+        self.crop_data = CropTable(img_path, self.crop_positions(img_path), self.crop_size)
+        self.n_shown = 0
+        if self.queue is not None:
+            # Every annotator must get the same order to share the blocks
+            self.crop_data.shuffle(np.random.default_rng(zlib.crc32(os.path.basename(img_path).encode())))
+        else:
+            self.crop_data.shuffle(self.rng)
+            self.exclude_annotated()
+        if self.ranker is not None:
+            self.ranker.schedule(self.image_pad, self.crop_data)
+        # The first crops are predicted before they are shown
+        if self.predictor is not None:
+            self.predictor.schedule(self.image_pad, self.crop_data, 0)
+
+    def exclude_annotated(self):
+        """
+        Remove the crops annotated before the session from the crop data
+        """
+        if not self.skip_annotated:
+            return
+        if self.annotated is None:
+            self.annotated = annotated_crops_index(self.outputpath, self.crop_size, self.include_archives)
+        keys = self.annotated.get(os.path.basename(self.crop_data.image))
+        if keys is not None:
+            self.crop_data.exclude(keys)
 
-        np.random.shuffle(self.crop_data)
+    def crop_positions(self, img_path):
+        """
+        Positions of the crops with significant foreground in the loaded image, from the crop plan
+        stored in the cache when there is one
+        :param img_path: path of the loaded image
+        :return: Array with shape [n_crops, 2] of the Y, X position of the crops
+        """
+        params = {"plan": True, "crop_size": self.crop_size, "crop_step": self.crop_step,
+                  "fg_threshold": self.fg_threshold, "lazy": self.lazy}
+        if self.cache is not None:
+            plan = self.cache.get(img_path, params, names=("crops",))
+            if plan is not None:
+                return plan[0]
+
+        positions = np.stack(np.nonzero(self.foreground_mask()), axis=1) * self.crop_step
+        if self.cache is not None:
+            self.cache.put(img_path, params, (positions,), names=("crops",))
+        return positions
+
+    @timing.timed("crop_scan")
+    def foreground_mask(self):
+        """
+        Check every position of the crop grid for significant foreground at once, using a
+        summed-area table of self.foreground. Only the rows and columns of the table at the
+        borders of the crops are kept, so the table is the size of the crop grid; the column
+        sums are accumulated from one crop border row to the next. Crops overlapping the
+        border of the image are compared to their area inside the image
+        :return: Boolean array with shape [n_rows, n_cols] of the crop grid
+        """
+        h, w = self.foreground.shape
+        y0 = np.arange(0, h, self.crop_step)
+        x0 = np.arange(0, w, self.crop_step)
+        y1 = np.minimum(y0 + self.crop_size, h)
+        x1 = np.minimum(x0 + self.crop_size, w)
+
+        ys = np.union1d(y0, y1)
+        xs = np.union1d(x0, x1)
+        integral = np.empty((len(ys), len(xs)), dtype='int64')
+        column = np.zeros(w, dtype='int64')
+        row = np.zeros(w + 1, dtype='int64')
+        start = 0
+        for i, y in enumerate(ys):
+            column += self.foreground[start:y].sum(axis=0, dtype='int64')
+            np.cumsum(column, out=row[1:])
+            integral[i] = row[xs]
+            start = y
+
+        iy0, iy1 = np.searchsorted(ys, y0), np.searchsorted(ys, y1)
+        ix0, ix1 = np.searchsorted(xs, x0), np.searchsorted(xs, x1)
+        fg_sum = integral[np.ix_(iy1, ix1)] - integral[np.ix_(iy0, ix1)] - integral[np.ix_(iy1, ix0)] + integral[np.ix_(iy0, ix0)]
+        area = (y1 - y0)[:, None] * (x1 - x0)[None, :]
+
+        return fg_sum >= area * self.fg_threshold
 
     def __iter__(self):
         return self
@@ -89,7 +484,18 @@ class Loader:
     def __next__(self):
         self.previous = 0
         self.atStopIteration= False
-        if self.n >= len(self.crop_data):
+        self.add_new_files()
+        if self.queue is not None:
+            if self.crop_data is not None and self.n < len(self.crop_data):
+                self.ensure_loaded()
+            # A block can be empty once the annotated crops are left out
+            while self.crop_data is None or self.n >= len(self.crop_data):
+                self.claim_block()
+                if self.file_idx >= len(self.files):
+                    break
+        elif self.file_idx < len(self.files):
+            self.ensure_loaded()
+        while self.queue is None and self.file_idx < len(self.files) and self.n >= len(self.crop_data):
             self.file_idx += 1
             self.x = 0
             self.y = 0
@@ -102,33 +508,77 @@ class Loader:
             self.atStopIteration = True
             raise StopIteration
 
-        crop = self.crop_data[self.n]
-        y = crop['Y']
-        x = crop['X']
-        size = crop['size']
-
-        pad_size = (self.total_size - self.crop_size)//2
-        n_pad = ((pad_size, pad_size), (pad_size, pad_size), (0, 0))
-        image_pad = np.pad(self.image, n_pad, mode='constant')
-
-        crop = image_pad[y:y+size+2*pad_size, x:x+size+2*pad_size].copy()
-        if crop.shape[0] != crop.shape[1]:
-            canvas = np.zeros((self.total_size, self.total_size, 3), dtype='uint8')
-            canvas[:crop.shape[0], :crop.shape[1], :] = crop
-            crop = canvas
-
-        crop = crop.astype('float32')
-        crop[...,0] = crop[...,0] - np.min(crop[...,0])
-        crop[...,1] = crop[...,1] - np.min(crop[...,1])
-        crop[...,0] = crop[...,0] / np.max(crop[...,0])
-        crop[...,1] = crop[...,1] / np.max(crop[...,1])
-        crop = np.clip(crop, 0, 1)
-        crop = (crop*255).astype('uint8')
+        if self.ranker is not None:
+            # The crops shown already keep their place, even when the user went back
+            self.ranker.apply(self.crop_data, max(self.n, self.n_shown))
+        crop = self.get_crop(self.n)
 
         self.n += 1
+        self.n_shown = max(self.n_shown, self.n)
+        if self.predictor is not None:
+            self.predictor.schedule(self.image_pad, self.crop_data, self.n - 1)
 
         return crop
 
+    def claim_block(self):
+        """
+        Mark the current block of crops as done and claim the next block of the shared queue. Images
+        are added to the queue in order, by the first annotator who needs their crops. When no block is
+        left, file_idx goes past the last file
+        """
+        if self.block is not None:
+            self.queue.complete(*self.block)
+            self.block = None
+        while True:
+            claim = self.queue.claim(self.files)
+            if claim is not None:
+                break
+            new_files = [idx for idx, fname in enumerate(self.files) if not self.queue.is_registered(fname)]
+            if not new_files:
+                self.file_idx = len(self.files)
+                return
+            self.file_idx = new_files[0]
+            img_path = os.path.join(self.path, self.files[self.file_idx])
+            self.generate_crops(img_path)
+            self.image_crops = self.crop_data
+            self.queue.register(self.files[self.file_idx], len(self.crop_data))
+
+        fname, block = claim
+        img_path = os.path.join(self.path, fname)
+        self.file_idx = self.files.index(fname)
+        if self.image_crops is None or self.image_crops.image != img_path:
+            self.generate_crops(img_path)
+            self.image_crops = self.crop_data
+        elif self.image_path != img_path:
+            self.load_image(img_path)
+        start = block * self.queue.block_size
+        self.crop_data = self.image_crops.subset(start, start + self.queue.block_size)
+        self.exclude_annotated()
+        self.block = (fname, block)
+        self.n = 0
+        self.n_shown = 0
+        if self.predictor is not None:
+            self.predictor.schedule(self.image_pad, self.crop_data, 0)
+
+    def get_crop(self, idx):
+        """
+        Extract the visualization crop of the given index in self.crop_data, normalized per channel
+        :param idx: index of the crop in self.crop_data
+        :return: Crop with shape [total_size, total_size, color]
+        """
+        return self.get_batch([idx])[0]
+
+    @timing.timed("crop_extraction")
+    def get_batch(self, indices):
+        """
+        Extract several visualization crops of self.crop_data at once. The crops are gathered from
+        the padded image and normalized with array operations over the whole batch
+        :param indices: indices of the crops in self.crop_data
+        :return: Crops with shape [n_crops, total_size, total_size, color]
+        """
+        rows = self.crop_data.array[np.asarray(indices, dtype='intp')]
+        return normalize_crops(gather_crops(self.image_pad, rows["Y"], rows["X"], self.total_size))
+
     def __previous__(self):
         if self.n < 1 :
             self.n = 0
@@ -137,29 +587,10 @@ class Loader:
 
         self.previous = self.previous- 1
         previous_n = self.n - 2
+        if self.file_idx < len(self.files):
+            self.ensure_loaded()
 
-        crop = self.crop_data[previous_n]
-        y = crop['Y']
-        x = crop['X']
-        size = crop['size']
-    
-        pad_size = (self.total_size - self.crop_size)//2
-        n_pad = ((pad_size, pad_size), (pad_size, pad_size), (0, 0))
-        image_pad = np.pad(self.image, n_pad, mode='constant')
-
-        crop = image_pad[y:y+size+2*pad_size, x:x+size+2*pad_size].copy()
-        if crop.shape[0] != crop.shape[1]:
-            canvas = np.zeros((self.total_size, self.total_size, 3), dtype='uint8')
-            canvas[:crop.shape[0], :crop.shape[1], :] = crop
-            crop = canvas
-
-        crop = crop.astype('float32')
-        crop[...,0] = crop[...,0] - np.min(crop[...,0])
-        crop[...,1] = crop[...,1] - np.min(crop[...,1])
-        crop[...,0] = crop[...,0] / np.max(crop[...,0])
-        crop[...,1] = crop[...,1] / np.max(crop[...,1])
-        crop = np.clip(crop, 0, 1)
-        crop = (crop*255).astype('uint8')
+        crop = self.get_crop(previous_n)
 
         self.n -= 1
         self.atStopIteration= False
@@ -176,74 +607,186 @@ class Loader:
         with open(os.path.join(self.outputpath,OUTPUT_FILE_NAME), "a") as file_object:
             file_object.write(os.path.join(self.outputpath, str(orig_fname_spplit[0])+'_'+str(self.n)+'.'+ext)+";"+str(classes)+";"+labelling_time+"\n")
 
+    @timing.timed("save_crop_data")
     def save_crop_data(self, classes, labelling_time, structure, ambiguous):
+        """
+        Write the annotation of the current crop. A crop annotated again after going back is
+        written too; its new record supersedes the old one
+        """
         orig_fname= os.path.join(self.path, self.files[self.file_idx])
-        orig_fname_spplit= os.path.splitext(self.files[self.file_idx])
         if len(self.crop_data)>self.n-1:
-            if self.previous>=0:
-                with open(os.path.join(self.outputpath,OUTPUT_FILE_NAME), "a") as file_object:
-                    file_object.write(orig_fname+";"+str(self.crop_data[self.n-1]['X'])+";"+str(self.crop_data[self.n-1]['Y'])+";"+str(self.crop_data[self.n-1]['size'])+";"+str(structure)+";"+str(classes)+";"+str(ambiguous)+";"+labelling_time+"\n")
-            else:
-                lines = open(os.path.join(self.outputpath,OUTPUT_FILE_NAME), 'r').readlines()
-                lines = lines[:self.previous]
-                lines.append(orig_fname+";"+str(self.crop_data[self.n-1]['X'])+";"+str(self.crop_data[self.n-1]['Y'])+";"+str(self.crop_data[self.n-1]['size'])+";"+str(structure)+";"+str(classes)+";"+str(ambiguous)+";"+labelling_time+"\n")
-                open(os.path.join(self.outputpath,OUTPUT_FILE_NAME), 'w').writelines(lines)
-                self.previous= 0
+            crop = self.crop_data[self.n-1]
+            self.persist("write_annotation", self.annotations.write, orig_fname, crop['X'], crop['Y'], crop['size'], structure, list(classes),
+                         list(ambiguous), labelling_time)
+            self.previous= 0
+            if self.queue is not None and self.block is not None:
+                self.queue.renew(*self.block)
+            if self.model is not None:
+                pad_size = (self.total_size - self.crop_size)//2
+                self.model.add(crop_features(self.image_pad, np.array([[crop['Y'], crop['X']]]), pad_size, self.crop_size),
+                               [classes], [structure])
+                if self.ranker is not None and self.ranker.annotated():
+                    self.ranker.schedule(self.image_pad, self.crop_data)
+
+    def prediction(self):
+        """
+        Proposed annotation of the current crop, when prefill is enabled and the prediction is ready
+        :return: List of the four class values and structure flag, or None
+        """
+        if self.predictor is None or self.n < 1:
+            return None
+        return self.predictor.get(self.crop_data, self.n - 1)
+
+    def prediction_pending(self):
+        """
+        Check if the proposed annotation of the current crop is being computed, so that the
+        interface can ask again for it later
+        """
+        if self.predictor is None or self.n < 1:
+            return False
+        return self.predictor.pending(self.crop_data, self.n - 1)
 
 
+    @timing.timed("saveHistory")
     def saveHistory(self, classes=[], structures=[], ambiguous=[], back=False):
         #☺ ne pas sauvegarder si l'utilisateur a parcouru dejà toutes les images
         save_n = self.n
         if back:
             save_n -= 1
 
-        self.deleteHistory()
         if self.atStopIteration:
+            self.deleteHistory()
             return
-        f_ow = open(HISTORY_F_NAME, "w")
-        last_data={"path":self.path, "outputpath":self.outputpath, 
-                   "file_idx":self.file_idx, "files":self.files, 
-                   "crop_data":self.crop_data, "n":save_n,
-                   "classes":classes, "structures":structures, "ambiguous":ambiguous }
-        json.dump(last_data, f_ow)
-        f_ow.close()
-        #with open(HISTORY_F_NAME, "w") as file_object:
+        # Copies of the lists, which the interface keeps changing while the writer thread saves them
+        last_data={"path":self.path, "outputpath":self.outputpath,
+                   "file_idx":self.file_idx, "files":list(self.files),
+                   "crop_data":self.crop_data, "n":save_n, "n_shown":max(save_n, self.n_shown), "block":self.block}
+        self.persist("write_history", self.history.save, last_data, list(classes), list(structures), list(ambiguous))
+
+    def persist(self, stage, fn, *args):
+        """
+        Run a write in the writer thread, or run it right away and flush the files when there is no writer
+        :param stage: Name of the timing stage of the write
+        """
+        if self.writer is not None:
+            self.writer.submit(stage, fn, *args)
+        else:
+            with timing.stage(stage):
+                fn(*args)
+            with timing.stage(FLUSH_STAGE):
+                self.commit(fsync=False)
+
+    def commit(self, fsync=True):
+        """
+        Flush the annotations and the history
+        :param fsync: Also wait until they are on the disk
+        """
+        if self.annotations is not None:
+            self.annotations.flush(fsync)
+        self.history.flush(fsync)
+
+    def write_errors(self):
+        """
+        Errors of the background writes since the last call, to be reported to the user
+        """
+        if self.writer is None:
+            return []
+        return self.writer.take_errors()
         
     #@classmethod
     #def loadHistory(cls, crop_size, crop_step, total_size):
     @staticmethod
-    def loadFromHistory( crop_size, crop_step, total_size):
+    def loadFromHistory( crop_size, crop_step, total_size, cache_dir=None, lazy=False, annotation_backend="text", ordering="random", prefill=False, annotator=None, watch=False, background_writes=False,
+                         skip_annotated=False, include_archives=False):
         mloader= None
-        if os.path.exists(HISTORY_F_NAME):
-            with open(HISTORY_F_NAME) as json_file:
-                data = json.load(json_file)
-                mloader = Loader( path=data["path"], outputpath=data["outputpath"], crop_size=crop_size, crop_step=crop_step, total_size=total_size) 
-                #mloader.path = data["path"]
-                #mloader.outputpath= data["outputpath"]
-                if os.path.exists(os.path.join( data["outputpath"],OUTPUT_FILE_NAME)):
-                    mloader.file_idx= data["file_idx"]
-                    mloader.files= data["files"]
-                    mloader.crop_data= data["crop_data"]
-                    mloader.n= data["n"]
-                    classes=data["classes"]
-                    structures=data["structures"]
-                    ambiguous=data["ambiguous"]
-                    mloader.load_image(os.path.join(mloader.path, mloader.files[mloader.file_idx]))#  mloader.generate_crops(os.path.join(mloader.path, mloader.files[mloader.file_idx]))
+        data = SessionJournal().load()
+        if data is not None:
+            mloader = Loader( path=data["path"], outputpath=data["outputpath"], crop_size=crop_size, crop_step=crop_step, total_size=total_size, cache_dir=cache_dir, lazy=lazy, annotation_backend=annotation_backend, ordering=ordering, prefill=prefill, annotator=annotator, watch=watch, background_writes=background_writes, skip_annotated=skip_annotated, include_archives=include_archives) 
+            #mloader.path = data["path"]
+            #mloader.outputpath= data["outputpath"]
+            if annotations_exist(data["outputpath"]):
+                # Histories of older versions can list files that are not images, such as .DS_Store
+                files = data["files"]
+                mloader.file_idx = sum(is_image_file(fname, lazy) for fname in files[:data["file_idx"]])
+                mloader.files = [fname for fname in files if is_image_file(fname, lazy)]
+                mloader.crop_data= data["crop_data"]
+                mloader.n= data["n"]
+                # Histories of older versions do not have it
+                mloader.n_shown = data.get("n_shown") or data["n"]
+                if data.get("block") is not None:
+                    mloader.block = tuple(data["block"])
+                    # The block was released when the session closed; another annotator may have claimed it since
+                    if mloader.queue is not None and not mloader.queue.reclaim(*mloader.block):
+                        mloader.block = None
+                        mloader.crop_data = None
+                        mloader.n = 0
+                        mloader.n_shown = 0
+                classes=data["classes"]
+                structures=data["structures"]
+                ambiguous=data["ambiguous"]
+                # The resumed file is loaded with the first crop request
             #return mloader
         return mloader
             
     def deleteHistory(self):
-        if os.path.exists(HISTORY_F_NAME):
-            os.remove(HISTORY_F_NAME)
+        self.persist("delete_history", self.history.delete)
             
     def renamePatchListFile(self):
+        if self.writer is not None:
+            self.writer.drain()
+        suffix = datetime.now().strftime("%Y%m%d%H%M%S")
+        self.annotations.archive(suffix)
         if os.path.exists(os.path.join(self.outputpath,OUTPUT_FILE_NAME)):
             fnamepath=os.path.join(self.outputpath,OUTPUT_FILE_NAME)
             fnamesplit = os.path.splitext(OUTPUT_FILE_NAME)
-            fnewnamepath=os.path.join(self.outputpath,fnamesplit[0]+"_"+datetime.now().strftime("%Y%m%d%H%M%S")+"."+fnamesplit[1] )        
+            fnewnamepath=os.path.join(self.outputpath,fnamesplit[0]+"_"+suffix+"."+fnamesplit[1] )        
             os.rename(fnamepath, fnewnamepath)
             #os.remove(HISTORY_F_NAME)
         
+def gather_crops(image_pad, ys, xs, size):
+    """
+    Copy crops of a padded image into one array. The crops of an array are gathered by a single
+    fancy indexing of its sliding window view; the crops of a LazyImage are read one by one
+    :param image_pad: Padded uint8 RGB image, or LazyImage
+    :param ys: Y positions of the crops
+    :param xs: X positions of the crops
+    :param size: Size of the crops
+    :return: uint8 array with shape [n_crops, size, size, color]
+    """
+    if isinstance(image_pad, np.ndarray):
+        # The windows have shape [color, size, size]; the gathered copy is laid out as [n_crops, size, size, color]
+        return sliding_window_view(image_pad, (size, size), axis=(0, 1))[ys, xs].transpose(0, 2, 3, 1)
+    batch = np.empty((len(ys), size, size, 3), dtype='uint8')
+    for i, (y, x) in enumerate(zip(ys, xs)):
+        batch[i] = image_pad[y:y+size, x:x+size]
+    return batch
+
+def normalize_crops(batch):
+    """
+    Stretch in place the first two channels of each crop to the full uint8 range, giving the same
+    values as normalizing each crop in float32. Each step runs on a whole channel of the batch
+    :param batch: uint8 crops with shape [n_crops, height, width, color]
+    :return: Normalized uint8 crops
+    """
+    n = len(batch)
+    for c in range(2):
+        channel = batch[..., c].astype('float32')
+        rows = channel.reshape(n, -1)
+        minimum = rows.min(axis=1)[:, None, None]
+        value_range = rows.max(axis=1)[:, None, None] - minimum
+        # A uniform channel would divide by zero; it becomes black
+        value_range[value_range == 0] = 1
+        # The values of a crop are within its min/max, so the stretched values need no clipping
+        channel -= minimum
+        channel /= value_range
+        channel *= 255
+        batch[..., c] = channel
+    # The third channel is empty unless the image had one
+    if batch[..., 2].any():
+        np.minimum(batch[..., 2], 1, out=batch[..., 2])
+        batch[..., 2] *= 255
+    return batch
+
 def generate_box(crop_size=128, total_size=256):
     """
     Generate the focus box in the center
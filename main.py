@@ -3,14 +3,29 @@ from PyQt5.QtCore import *
 from PyQt5.QtGui import QPixmap, QImage
 import os
 from gui import Ui_JunctionAnnotator
-from loader import Loader, generate_box, HISTORY_F_NAME, OUTPUT_FILE_NAME
+from loader import Loader, generate_box, HISTORY_F_NAME, OUTPUT_FILE_NAME, annotations_exist
+from cache import DEFAULT_CACHE_DIR
 import numpy as np
 import sys
 import time
+import timing
 
 CROP_SIZE = 64
 CROP_STEP = int(64*0.75)
 TOTAL_SIZE = 128
+REDRAW_INTERVAL_MS = 16  # At most one redraw per frame while dragging the intensity sliders
+PREDICTION_POLL_MS = 50  # Interval of the checks for the proposed annotation of a crop being predicted
+CACHE_DIR = DEFAULT_CACHE_DIR
+LAZY_LOADING = True
+ANNOTATION_BACKEND = "text"  # "text" or "sqlite"
+CROP_ORDERING = "random"  # "random" or "active" to show first the crops the model trained on the annotations is unsure of
+PREFILL_CLASSES = False  # Propose the class values and structure predicted from the past annotations
+ANNOTATOR = None  # Name of the annotator, e.g. getpass.getuser(), to share the crops of the dataset with other annotators
+WATCH_DIRECTORY = False  # Add the images written to the source directory during the session
+BACKGROUND_WRITES = True  # Save the annotations and the history in a writer thread so that the interface never waits on the disk
+SKIP_ANNOTATED = True  # Leave out the crops already in the patch list files of the destination directory
+INCLUDE_ARCHIVES = False  # Also leave out the crops of the archived patchlist_<date>.txt files
+STRUCTURE_NAMES = {0: "no structure", 1: "structure", 2: "ambiguous"}
 
 class App(QMainWindow, Ui_JunctionAnnotator):
     def __init__(self):
@@ -21,7 +36,8 @@ class App(QMainWindow, Ui_JunctionAnnotator):
         if self.loader is None:
             self.path = self.select_path(title="Select source path")
             self.outputpath = self.select_path(title="Select patch destination path")
-            self.loader = Loader(path=self.path, outputpath=self.outputpath, crop_size=CROP_SIZE, crop_step=CROP_STEP, total_size=TOTAL_SIZE)
+            self.loader = Loader(path=self.path, outputpath=self.outputpath, crop_size=CROP_SIZE, crop_step=CROP_STEP, total_size=TOTAL_SIZE, cache_dir=CACHE_DIR, lazy=LAZY_LOADING, annotation_backend=ANNOTATION_BACKEND, ordering=CROP_ORDERING, prefill=PREFILL_CLASSES, annotator=ANNOTATOR, watch=WATCH_DIRECTORY, background_writes=BACKGROUND_WRITES,
+                                 skip_annotated=SKIP_ANNOTATED, include_archives=INCLUDE_ARCHIVES)
             self.check_patch_file_exists()
         else:
             self.path = self.loader.path
@@ -42,6 +58,10 @@ class App(QMainWindow, Ui_JunctionAnnotator):
         self.mouse_x, self.mouse_y = 0, 0
         self.dragging = False
         self.swap_colors = True
+        self.displayed_crop = None
+        self.crop_version = 0
+        self.display_key = None
+        self.scaled_pixmap = None
 
         # Group ambiguous checkboxes
         self.check_ambiguous_list = [self.check_ambigu_class_1, self.check_ambigu_class_2, self.check_ambigu_class_3, self.check_ambigu_class_4]
@@ -49,6 +69,13 @@ class App(QMainWindow, Ui_JunctionAnnotator):
         self.spin_class_list = [self.Spin_class_1, self.Spin_class_2, self.Spin_class_3, self.Spin_class_4]
 
 
+        # Applies the proposed annotation of the current crop once it is predicted
+        self.prediction_timer = QTimer(self)
+        self.prediction_timer.setSingleShot(True)
+        self.prediction_timer.setInterval(PREDICTION_POLL_MS)
+        self.prediction_timer.timeout.connect(self.propose_late_annotation)
+        self.proposal_version = None
+
         # Initial image
         self.box = generate_box(self.loader.crop_size, self.loader.total_size)
         self.next_crop()
@@ -60,8 +87,12 @@ class App(QMainWindow, Ui_JunctionAnnotator):
         self.button_submit.clicked.connect(self.submit)
         self.button_previous.clicked.connect(self.goBackward)
         self.button_pause.clicked.connect(self.pause)
-        self.slider_intensity_ch0.valueChanged.connect(self.display_crop)
-        self.slider_intensity_ch1.valueChanged.connect(self.display_crop)
+        self.redraw_timer = QTimer(self)
+        self.redraw_timer.setSingleShot(True)
+        self.redraw_timer.setInterval(REDRAW_INTERVAL_MS)
+        self.redraw_timer.timeout.connect(self.display_crop)
+        self.slider_intensity_ch0.valueChanged.connect(self.schedule_redraw)
+        self.slider_intensity_ch1.valueChanged.connect(self.schedule_redraw)
         self.slider_intensity_ch0.mouseDoubleClickEvent = self.reset_contrast
         self.slider_intensity_ch1.mouseDoubleClickEvent = self.reset_contrast
         self.label_ch1.mousePressEvent = self.action_swap_colors
@@ -100,16 +131,11 @@ class App(QMainWindow, Ui_JunctionAnnotator):
 
     def reset_class_values(self):
         self.labelValues = [0.5 for _ in range(4)]
+        self.classes_edited = False
 
-        self.slider_class_1.setValue(50)
-        self.slider_class_2.setValue(50)
-        self.slider_class_3.setValue(50)
-        self.slider_class_4.setValue(50)
-
-        self.Spin_class_1.setValue(0.5)
-        self.Spin_class_2.setValue(0.5)
-        self.Spin_class_3.setValue(0.5)
-        self.Spin_class_4.setValue(0.5)
+        for slider, spin in zip(self.slider_class_list, self.spin_class_list):
+            self.set_silently(slider, 50)
+            self.set_silently(spin, 0.5)
 
         for check in self.check_ambiguous_list:
             check.setChecked(False)
@@ -118,15 +144,52 @@ class App(QMainWindow, Ui_JunctionAnnotator):
     def set_class_values(self, classes):
         self.labelValues = classes
 
-        self.slider_class_1.setValue(int(self.labelValues[0]*100))
-        self.slider_class_2.setValue(int(self.labelValues[1]*100))
-        self.slider_class_3.setValue(int(self.labelValues[2]*100))
-        self.slider_class_4.setValue(int(self.labelValues[3]*100))
+        for i, (slider, spin) in enumerate(zip(self.slider_class_list, self.spin_class_list)):
+            self.set_silently(slider, int(self.labelValues[i]*100))
+            self.set_silently(spin, self.labelValues[i])
+
+    def propose_annotation(self):
+        """
+        Pre-fill the class values with the prediction of the current crop, and give the focus to the
+        button of the predicted structure so that the annotator only has to confirm or correct it
+        """
+        prediction = self.loader.prediction()
+        if prediction is None:
+            self.statusbar.clearMessage()
+            if self.loader.prediction_pending():
+                self.proposal_version = self.crop_version
+                self.prediction_timer.start()
+            return
+        classes, structure = prediction
+        self.set_class_values([round(value, 2) for value in classes])
+        button = {0: self.button_skip, 1: self.button_submit, 2: self.button_ambiguous}[structure]
+        button.setFocus()
+        self.statusbar.showMessage("Proposed: " + STRUCTURE_NAMES[structure])
+
+    def propose_late_annotation(self):
+        """
+        Propose the annotation predicted after the crop was shown, unless the annotator moved to
+        another crop or changed the class values in the meantime
+        """
+        if self.proposal_version == self.crop_version and not self.classes_edited:
+            self.propose_annotation()
 
-        self.Spin_class_1.setValue(self.labelValues[0])
-        self.Spin_class_2.setValue(self.labelValues[1])
-        self.Spin_class_3.setValue(self.labelValues[2])
-        self.Spin_class_4.setValue(self.labelValues[3])
+    def set_silently(self, widget, value):
+        """
+        Set the value of a slider or spin box without emitting valueChanged, so that a slider and
+        its spin box do not update each other back and forth
+        """
+        widget.blockSignals(True)
+        widget.setValue(value)
+        widget.blockSignals(False)
+
+    def schedule_redraw(self):
+        """
+        Redraw the crop at the end of the current frame interval; the changes received in the
+        meantime are merged into that single redraw
+        """
+        if not self.redraw_timer.isActive():
+            self.redraw_timer.start()
 
     def timerUpdateTime(self):
         #
@@ -150,7 +213,8 @@ class App(QMainWindow, Ui_JunctionAnnotator):
         return path
     
     def check_patch_file_exists(self):
-        if os.path.exists(os.path.join(self.outputpath,OUTPUT_FILE_NAME)):
+        # The files of a shared output directory belong to every annotator
+        if ANNOTATOR is None and annotations_exist(self.outputpath):
             msgbox = QMessageBox(QMessageBox.Question,'Append patch list file',
                               f"The output directory <i>{self.outputpath}</i> already contains a patch list file. Do you want to append the new data to this old file ? <br/> (If you choose <b>No</b>, the old file will be automatically renamed and a new file will be created.)")
             msgbox.addButton(QMessageBox.Yes)
@@ -171,25 +235,30 @@ class App(QMainWindow, Ui_JunctionAnnotator):
 
             rep = msgbox.exec()
             if rep == QMessageBox.Yes:
-                loader = Loader.loadFromHistory(crop_size=crop_size, crop_step=crop_step, total_size=TOTAL_SIZE)
+                loader = Loader.loadFromHistory(crop_size=crop_size, crop_step=crop_step, total_size=TOTAL_SIZE, cache_dir=CACHE_DIR, lazy=LAZY_LOADING, annotation_backend=ANNOTATION_BACKEND, ordering=CROP_ORDERING, prefill=PREFILL_CLASSES, annotator=ANNOTATOR, watch=WATCH_DIRECTORY, background_writes=BACKGROUND_WRITES,
+                                 skip_annotated=SKIP_ANNOTATED, include_archives=INCLUDE_ARCHIVES)
                 return loader
 
         return None
 
 
+    @timing.timed("display_crop")
     def display_crop(self):
         """
-        Update the displayed crop
+        Update the displayed crop. The scaled pixmap is only rebuilt when the crop, the contrast
+        or the zoom changed; the QImage wraps the display buffer without copying it
         """
-        self.label_image.clear()
-        self.displayed_crop = self.crop.copy()
-        self.update_contrast()
-        h, w, c = self.displayed_crop.shape
-        img = np.transpose(self.displayed_crop, (1,0,2)).copy()
-
-        pixmap = QImage(img, w, h, QImage.Format_RGB888)
-        q_pixmap = QPixmap(pixmap)
-        self.label_image.setPixmap(q_pixmap.scaled(self.label_image.size()))
+        target_size = self.label_image.size()
+        display_key = (self.crop_version, self.slider_intensity_ch0.value(), self.slider_intensity_ch1.value(),
+                       self.swap_colors, float(self.zoom_level), target_size.width(), target_size.height())
+        if display_key != self.display_key:
+            self.update_contrast()
+            h, w, c = self.displayed_crop.shape
+            image = QImage(self.displayed_crop.data, w, h, self.displayed_crop.strides[0], QImage.Format_RGB888)
+            self.scaled_pixmap = QPixmap.fromImage(image).scaled(target_size)
+            self.display_key = display_key
+
+        self.label_image.setPixmap(self.scaled_pixmap)
         self.label_image.resize(self.zoom_level * self.label_image.pixmap().size())
 
         self.show()
@@ -245,8 +314,11 @@ class App(QMainWindow, Ui_JunctionAnnotator):
         Closing windows:
             save history
             save last edited file
+            stop the prefetch worker
         """
-        self.loader.saveHistory(self.hist_classes, self.hist_structures, self.hist_ambiguouss)
+        self.loader.saveHistory(self.hist_classes, self.hist_structures, self.hist_ambiguous)
+        self.loader.close()
+        self.report_write_errors()
         
 
     def skip(self):
@@ -282,17 +354,28 @@ class App(QMainWindow, Ui_JunctionAnnotator):
         self.start_action()
 
 
+    def report_write_errors(self):
+        """
+        Tell the user about the annotations or history that could not be saved by the writer thread
+        """
+        errors = self.loader.write_errors()
+        if errors:
+            QMessageBox.critical(self, 'Save failed', "Some annotations could not be saved:<br/>" +
+                                 "<br/>".join(str(e) for e in errors[:5]))
+
     def next_crop(self):
         """
         Display the next crop to label
         """
+        self.report_write_errors()
         self.time_steps = []
         self.current_time = time.time()
         self.reset_class_values()
 
         try:
             self.crop = self.loader.__next__()
-            self.crop = np.transpose(self.crop, axes=[1,0,2])
+            self.crop_version += 1
+            self.propose_annotation()
         except StopIteration:
             end_dialog = QMessageBox()
             end_dialog.setIcon(QMessageBox.Information)
@@ -330,7 +413,7 @@ class App(QMainWindow, Ui_JunctionAnnotator):
                return
            else:
                self.crop = p_crop
-               self.crop = np.transpose(self.crop, axes=[1, 0, 2])
+               self.crop_version += 1
                self.reset_class_values()
                classes=self.hist_classes[-1]
                self.hist_classes=self.hist_classes[:-1]
@@ -388,32 +471,14 @@ class App(QMainWindow, Ui_JunctionAnnotator):
 
 
     def update_class_value(self, i):
-        if i==1:
-            self.labelValues[0]= self.slider_class_1.value()/100
-            self.Spin_class_1.setValue(self.labelValues[0])
-        if i==2:
-            self.labelValues[1]= self.slider_class_2.value()/100
-            self.Spin_class_2.setValue(self.labelValues[1])
-        if i==3:
-            self.labelValues[2]= self.slider_class_3.value()/100
-            self.Spin_class_3.setValue(self.labelValues[2])
-        if i==4:
-            self.labelValues[3]= self.slider_class_4.value()/100
-            self.Spin_class_4.setValue(self.labelValues[3])
+        self.labelValues[i-1]= self.slider_class_list[i-1].value()/100
+        self.classes_edited = True
+        self.set_silently(self.spin_class_list[i-1], self.labelValues[i-1])
        
     def update_spin_class_value(self, i):
-        if i==1:
-            self.labelValues[0]= self.Spin_class_1.value()
-            self.slider_class_1.setValue(int(self.labelValues[0]*100))
-        if i==2:
-            self.labelValues[1]= self.Spin_class_2.value()
-            self.slider_class_2.setValue(int(self.labelValues[1]*100))
-        if i==3:
-            self.labelValues[2]= self.Spin_class_3.value()
-            self.slider_class_3.setValue(int(self.labelValues[2]*100))
-        if i==4:
-            self.labelValues[3]= self.Spin_class_4.value()
-            self.slider_class_4.setValue(int(self.labelValues[3]*100))
+        self.labelValues[i-1]= self.spin_class_list[i-1].value()
+        self.classes_edited = True
+        self.set_silently(self.slider_class_list[i-1], int(self.labelValues[i-1]*100))
 
     def update_ambiguous_checks(self):
         """
@@ -431,22 +496,24 @@ class App(QMainWindow, Ui_JunctionAnnotator):
 
     def update_contrast(self):
         """
-        Update the contrast of the image
+        Update the contrast of the image. Each channel goes through a 256 entries lookup table
+        built from its intensity slider, written straight into the preallocated display buffer
         """
-        # Intensity
-        # channel 0
-        self.displayed_crop[...,0] = np.clip(self.crop[...,0].astype('float') * self.slider_intensity_ch0.value()/100, 0, 255).astype('uint8').copy()
+        if self.displayed_crop is None or self.displayed_crop.shape != self.crop.shape:
+            self.displayed_crop = np.empty_like(self.crop)
+            self.box_index = np.flatnonzero(self.box)
 
-        # channel 1
-        self.displayed_crop[...,1] = np.clip(self.crop[...,1].astype('float') * self.slider_intensity_ch1.value()/100, 0, 255).astype('uint8').copy()
+        # Intensity
+        lut_ch0 = np.clip(np.arange(256) * self.slider_intensity_ch0.value()/100, 0, 255).astype('uint8')
+        lut_ch1 = np.clip(np.arange(256) * self.slider_intensity_ch1.value()/100, 0, 255).astype('uint8')
 
         # Reverse colors if needed
-        if self.swap_colors:
-            buffer = self.displayed_crop[...,1].copy()
-            self.displayed_crop[...,1] = self.displayed_crop[...,0].copy()
-            self.displayed_crop[...,0] = buffer
+        dest_ch0, dest_ch1 = (1, 0) if self.swap_colors else (0, 1)
+        np.take(lut_ch0, self.crop[...,0], out=self.displayed_crop[...,dest_ch0])
+        np.take(lut_ch1, self.crop[...,1], out=self.displayed_crop[...,dest_ch1])
+        self.displayed_crop[...,2] = self.crop[...,2]
 
-        self.displayed_crop[self.box] = 255
+        self.displayed_crop.reshape(-1)[self.box_index] = 255
 
     def reset_contrast(self, event):
         """
@@ -455,7 +522,7 @@ class App(QMainWindow, Ui_JunctionAnnotator):
         """
         self.slider_intensity_ch0.setValue(100)
         self.slider_intensity_ch1.setValue(100)
-        self.display_crop()
+        self.schedule_redraw()
 
     def pause(self):
         """
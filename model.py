@@ -0,0 +1,160 @@
+import threading
+import numpy as np
+from annotations import read_records
+
+# Number of crops whose features are computed at once
+FEATURE_CHUNK = 512
+# Number of crops compared to the training set at once
+QUERY_CHUNK = 1024
+N_FEATURES = 9
+# Number of past annotations used to train the model at startup
+MAX_BOOTSTRAP_RECORDS = 5000
+
+
+def crop_features(image_pad, positions, pad_size, crop_size, stop=None):
+    """
+    Cheap intensity and texture features of the crops of interest, computed on the padded image
+    so that they are comparable between the crops of an image: mean, standard deviation, mean
+    gradient and proportion of bright pixels of the two channels, and correlation of the channels
+    :param image_pad: Padded uint8 RGB image, or LazyImage
+    :param positions: Array with shape [n_crops, 2] of the Y, X position of the crops
+    :param pad_size: Padding around the crops of interest
+    :param crop_size: Size of the crops of interest
+    :param stop: threading.Event checked between chunks; the computation is abandoned when it is set
+    :return: float32 array with shape [n_crops, N_FEATURES], or None if it was stopped
+    """
+    features = np.empty((len(positions), N_FEATURES), dtype='float32')
+    for start in range(0, len(positions), FEATURE_CHUNK):
+        if stop is not None and stop.is_set():
+            return None
+        chunk = positions[start:start+FEATURE_CHUNK]
+        regions = np.empty((len(chunk), 2, crop_size, crop_size), dtype='float32')
+        for i, (y, x) in enumerate(chunk):
+            region = image_pad[y+pad_size:y+pad_size+crop_size, x+pad_size:x+pad_size+crop_size]
+            regions[i] = np.moveaxis(region[..., :2], -1, 0)
+        regions /= 255
+
+        mean = regions.mean(axis=(2, 3))
+        std = regions.std(axis=(2, 3))
+        gradient = (np.abs(np.diff(regions, axis=2)).mean(axis=(2, 3)) + np.abs(np.diff(regions, axis=3)).mean(axis=(2, 3))) / 2
+        bright = (regions > (mean + std)[:, :, None, None]).mean(axis=(2, 3))
+        centered = regions - mean[:, :, None, None]
+        covariance = (centered[:, 0] * centered[:, 1]).mean(axis=(1, 2))
+        correlation = covariance / np.maximum(std[:, 0] * std[:, 1], 1e-6)
+
+        features[start:start+len(chunk)] = np.concatenate((mean, std, gradient, bright, correlation[:, None]), axis=1)
+    return features
+
+
+class CropModel:
+
+    def __init__(self, k=10):
+        """
+        k nearest neighbours model of the annotations, on standardized crop features. Adding an
+        annotation is an append, so the model is refitted incrementally at no cost
+        :param k: Number of neighbours
+        """
+        self.k = k
+        self.lock = threading.Lock()
+        self.features = np.zeros((0, N_FEATURES), dtype='float32')
+        self.classes = np.zeros((0, 4), dtype='float32')
+        self.structures = np.zeros(0, dtype='int8')
+        # Set when the session closes, to end the computations of the model worker early
+        self.stopped = threading.Event()
+
+    def __len__(self):
+        return len(self.structures)
+
+    def add(self, features, classes, structures):
+        """
+        Add annotated crops
+        :param features: Array with shape [n_crops, N_FEATURES]
+        :param classes: Values of the four classes, with shape [n_crops, 4]
+        :param structures: Structure flags of the crops
+        """
+        with self.lock:
+            self.features = np.concatenate((self.features, np.asarray(features, dtype='float32')))
+            self.classes = np.concatenate((self.classes, np.asarray(classes, dtype='float32').reshape(-1, 4)))
+            self.structures = np.concatenate((self.structures, np.asarray(structures, dtype='int8').reshape(-1)))
+
+    def stop(self):
+        """
+        Make bootstrap and the feature computations that check self.stopped return early
+        """
+        self.stopped.set()
+
+    def bootstrap(self, outputpath, load_fn, pad_size, crop_size):
+        """
+        Add the annotations already written in an output directory. Each source image is read once.
+        Checks self.stopped between images
+        :param outputpath: Output directory of the annotator
+        :param load_fn: Function taking an image path and returning the padded image; it does not need
+                        the foreground, see Loader.open_image
+        :param pad_size: Padding around the crops of interest
+        :param crop_size: Size of the crops of interest
+        """
+        groups = {}
+        for _, record in read_records(outputpath)[-MAX_BOOTSTRAP_RECORDS:]:
+            groups.setdefault(record["image"], []).append(record)
+        for img_path, records in groups.items():
+            if self.stopped.is_set():
+                return
+            try:
+                image_pad = load_fn(img_path)
+            except Exception as e:
+                print("Could not read the annotations of", img_path, ":", e)
+                continue
+            positions = np.array([(record["Y"], record["X"]) for record in records])
+            features = crop_features(image_pad, positions, pad_size, crop_size, self.stopped)
+            if features is None:
+                return
+            self.add(features, [record["classes"] for record in records], [record["structure"] for record in records])
+
+    def neighbours(self, features):
+        """
+        Find the nearest annotated crops
+        :param features: Array with shape [n_crops, N_FEATURES]
+        :return: Classes with shape [n_crops, k, 4] and structures with shape [n_crops, k] of the
+                 neighbours, or None if the model has no annotation
+        """
+        with self.lock:
+            train, classes, structures = self.features, self.classes, self.structures
+        if len(train) == 0:
+            return None
+        mean, std = train.mean(axis=0), train.std(axis=0) + 1e-6
+        train = (train - mean) / std
+        k = min(self.k, len(train))
+
+        indices = np.empty((len(features), k), dtype='int64')
+        for start in range(0, len(features), QUERY_CHUNK):
+            query = (features[start:start+QUERY_CHUNK] - mean) / std
+            distances = (query**2).sum(axis=1)[:, None] - 2*query @ train.T + (train**2).sum(axis=1)[None, :]
+            indices[start:start+len(query)] = np.argpartition(distances, k-1, axis=1)[:, :k]
+        return classes[indices], structures[indices]
+
+    def uncertainty(self, features):
+        """
+        Disagreement of the neighbours of each crop: standard deviation of their class values plus
+        the proportion of neighbours whose structure flag differs from the majority
+        :return: float32 array with shape [n_crops]; all ones when the model has no annotation
+        """
+        neighbours = self.neighbours(features)
+        if neighbours is None:
+            return np.ones(len(features), dtype='float32')
+        classes, structures = neighbours
+        counts = np.stack([(structures == s).sum(axis=1) for s in range(3)], axis=1)
+        disagreement = 1 - counts.max(axis=1) / structures.shape[1]
+        return (classes.std(axis=1).mean(axis=1) + disagreement).astype('float32')
+
+    def predict(self, features):
+        """
+        Predict the annotation of crops from their neighbours
+        :return: Mean class values of the neighbours with shape [n_crops, 4] and most frequent structure
+                 flag of the neighbours with shape [n_crops], or None if the model has no annotation
+        """
+        neighbours = self.neighbours(features)
+        if neighbours is None:
+            return None
+        classes, structures = neighbours
+        counts = np.stack([(structures == s).sum(axis=1) for s in range(3)], axis=1)
+        return classes.mean(axis=1), counts.argmax(axis=1)
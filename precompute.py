@@ -0,0 +1,64 @@
+"""
+Prepare the foreground masks and crop plans of every image of a directory before annotating it.
+The results go to the cache used by the annotator, which then skips the preprocessing
+
+Usage: python precompute.py <image directory> [--workers N] [--cache-dir DIR]
+"""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import argparse
+import os
+import time
+from loader import Loader
+from cache import DEFAULT_CACHE_DIR
+from watcher import list_images
+
+
+def precompute_file(path, fname, options):
+    """
+    Load an image and generate its crops with a loader writing to the cache
+    :param path: Directory of the images
+    :param fname: Name of the image in the directory
+    :param options: dict of Loader arguments
+    :return: Name of the image, number of candidate crops and time taken in seconds
+    """
+    start = time.time()
+    loader = Loader(path=path, prefetch=0, **options)
+    loader.generate_crops(os.path.join(path, fname))
+    return fname, len(loader.crop_data), time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute the foreground masks and crop plans of a directory of images")
+    parser.add_argument("path", help="Directory of the images to annotate")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR, help="Cache directory read by the annotator")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of worker processes")
+    parser.add_argument("--crop-size", type=int, default=64)
+    parser.add_argument("--crop-step", type=int, default=int(64*0.75))
+    parser.add_argument("--total-size", type=int, default=128)
+    parser.add_argument("--fg-threshold", type=float, default=0.1)
+    parser.add_argument("--lazy", action=argparse.BooleanOptionalAction, default=True,
+                        help="Memory-map the images, as the annotator does with LAZY_LOADING")
+    args = parser.parse_args()
+
+    options = {"crop_size": args.crop_size, "crop_step": args.crop_step, "total_size": args.total_size,
+               "fg_threshold": args.fg_threshold, "cache_dir": args.cache_dir, "lazy": args.lazy}
+    files = sorted(list_images(args.path, args.lazy))
+
+    start = time.time()
+    total_crops = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(precompute_file, args.path, fname, options): fname for fname in files}
+        for future in as_completed(futures):
+            try:
+                fname, n_crops, duration = future.result()
+            except Exception as e:
+                print(f"{futures[future]}\tfailed: {e}")
+                continue
+            total_crops += n_crops
+            print(f"{fname}\t{n_crops} crops\t{duration:.2f} s")
+
+    print(f"{len(files)} files\t{total_crops} crops\t{time.time() - start:.2f} s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+import threading
+import numpy as np
+from model import crop_features
+
+
+class CropPredictor:
+
+    def __init__(self, model, worker, pad_size, crop_size, lookahead=3):
+        """
+        Propose the annotation of the upcoming crops with the model of the annotations. Predictions are
+        computed in the background worker ahead of time, so that getting the prediction of a crop never waits.
+        A prediction made before the model got new annotations is computed again when it is scheduled
+        :param model: CropModel trained on the annotations
+        :param worker: Executor running the model computations
+        :param pad_size: Padding around the crops of interest
+        :param crop_size: Size of the crops of interest
+        :param lookahead: Number of upcoming crops predicted in advance
+        """
+        self.model = model
+        self.worker = worker
+        self.pad_size = pad_size
+        self.crop_size = crop_size
+        self.lookahead = lookahead
+
+        self.lock = threading.Lock()
+        self.image = None
+        # Class values, structure flag and number of annotations of the model, by crop key
+        self.predictions = {}
+        # Keys of the crops being predicted
+        self.scheduled = set()
+
+    def schedule(self, image_pad, crop_data, start):
+        """
+        Predict the crops following start that are not predicted yet, or were predicted by a smaller model
+        :param image_pad: Padded image of the crops
+        :param crop_data: CropTable of the image
+        :param start: Index of the first crop to predict
+        """
+        keys = crop_data.keys()[start:start+self.lookahead]
+        with self.lock:
+            if crop_data.image != self.image:
+                self.image = crop_data.image
+                self.predictions = {}
+                self.scheduled = set()
+            n_annotations = len(self.model)
+            keys = np.array([key for key in keys.tolist() if key not in self.scheduled
+                             and (key not in self.predictions or self.predictions[key][2] < n_annotations)], dtype='int64')
+            self.scheduled.update(keys.tolist())
+        if len(keys):
+            self.worker.submit(self._predict, image_pad, crop_data.image, keys)
+
+    def _predict(self, image_pad, image, keys):
+        positions = np.stack((keys >> 32, keys & 0xffffffff), axis=1)
+        features = crop_features(image_pad, positions, self.pad_size, self.crop_size, self.model.stopped)
+        if features is None:
+            return
+        n_annotations = len(self.model)
+        prediction = self.model.predict(features)
+        with self.lock:
+            if image != self.image:
+                return
+            self.scheduled.difference_update(keys.tolist())
+            if prediction is None:
+                # Nothing to predict from yet; try again later
+                return
+            classes, structures = prediction
+            for key, crop_classes, structure in zip(keys.tolist(), classes.tolist(), structures.tolist()):
+                self.predictions[key] = (crop_classes, structure, n_annotations)
+
+    def get(self, crop_data, idx):
+        """
+        Prediction of a crop, if it is ready; never waits for the worker
+        :param crop_data: CropTable of the image
+        :param idx: Index of the crop in crop_data
+        :return: List of the four class values and structure flag, or None
+        """
+        crop = crop_data[idx]
+        key = (crop['Y'] << 32) | crop['X']
+        with self.lock:
+            if crop_data.image != self.image or key not in self.predictions:
+                return None
+            crop_classes, structure, _ = self.predictions[key]
+            return crop_classes, structure
+
+    def pending(self, crop_data, idx):
+        """
+        Check if the first prediction of a crop is being computed
+        """
+        crop = crop_data[idx]
+        key = (crop['Y'] << 32) | crop['X']
+        with self.lock:
+            return crop_data.image == self.image and key in self.scheduled and key not in self.predictions
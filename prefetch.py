@@ -0,0 +1,97 @@
+from concurrent.futures import ThreadPoolExecutor, CancelledError
+import threading
+
+
+class Prefetcher:
+
+    def __init__(self, load_fn, n_files=1, max_bytes=2*1024**3, size_fn=None):
+        """
+        Prepare upcoming images in a background thread while the current one is annotated
+        :param load_fn: Function taking an image path and returning a tuple of numpy arrays
+        :param n_files: Number of upcoming files to prepare
+        :param max_bytes: Maximum number of bytes held by prepared images, counting the images being
+                          prepared; files over the budget are left to be loaded on demand
+        :param size_fn: Function taking an image path and returning an estimate of the number of bytes
+                        held by its prepared result, computed before loading it. None counts 0 bytes
+        """
+        self.load_fn = load_fn
+        self.n_files = n_files
+        self.max_bytes = max_bytes
+        self.size_fn = size_fn
+
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch")
+        self.futures = {}
+        # Estimated size of the result of each future
+        self.sizes = {}
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def estimate(self, img_path):
+        if self.size_fn is None:
+            return 0
+        try:
+            return self.size_fn(img_path)
+        except Exception as e:
+            print("Could not estimate the size of", img_path, ":", e)
+            return self.max_bytes + 1
+
+    def _load(self, img_path):
+        if self.closed:
+            return None
+        return self.load_fn(img_path)
+
+    def schedule(self, img_paths):
+        """
+        Prepare the given images, in order, as long as the images prepared or being prepared fit in
+        max_bytes. Prepared images that are not requested anymore are dropped
+        :param img_paths: List of image paths
+        """
+        if self.closed:
+            return
+        with self.lock:
+            for img_path in list(self.futures):
+                if img_path not in img_paths:
+                    self.futures.pop(img_path).cancel()
+                    self.sizes.pop(img_path)
+            held = sum(self.sizes.values())
+            for img_path in img_paths:
+                if img_path in self.futures:
+                    continue
+                size = self.estimate(img_path)
+                if held + size > self.max_bytes:
+                    # This file and the following ones are loaded on demand
+                    break
+                held += size
+                self.futures[img_path] = self.executor.submit(self._load, img_path)
+                self.sizes[img_path] = size
+
+    def get(self, img_path):
+        """
+        Get a prepared image, waiting for it if it is being prepared
+        :param img_path: path of the image
+        :return: Result of load_fn, or None if the image was not prepared
+        """
+        with self.lock:
+            future = self.futures.pop(img_path, None)
+            self.sizes.pop(img_path, None)
+        if future is None:
+            return None
+        try:
+            return future.result()
+        except CancelledError:
+            return None
+        except Exception as e:
+            print("Prefetch of", img_path, "failed:", e)
+            return None
+
+    def close(self):
+        """
+        Cancel pending work and release prepared images
+        """
+        self.closed = True
+        with self.lock:
+            for future in self.futures.values():
+                future.cancel()
+            self.futures = {}
+            self.sizes = {}
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,80 @@
+import numpy as np
+from model import crop_features
+
+
+class ActiveLearningRanker:
+
+    def __init__(self, model, worker, pad_size, crop_size, refit_every=20):
+        """
+        Order the crops of the queue by the uncertainty of the model of the annotations, so that the
+        crops the model cannot predict from the past annotations come first. Features and scores are
+        computed in the background worker; the loader applies the new order when it is ready
+        :param model: CropModel trained on the annotations
+        :param worker: Executor running the model computations
+        :param pad_size: Padding around the crops of interest
+        :param crop_size: Size of the crops of interest
+        :param refit_every: Number of annotations after which the queue is ranked again
+        """
+        self.model = model
+        self.worker = worker
+        self.pad_size = pad_size
+        self.crop_size = crop_size
+        self.refit_every = refit_every
+
+        self.pending = None
+        self.n_new = 0
+        # Image path, keys and features of the crops of the current image
+        self.table_features = (None, None, None)
+
+    def annotated(self):
+        """
+        Count an annotation added to the model
+        :return: True when the queue should be ranked again
+        """
+        self.n_new += 1
+        if self.n_new >= self.refit_every:
+            self.n_new = 0
+            return True
+        return False
+
+    def schedule(self, image_pad, crop_data):
+        """
+        Rank the crops of a crop table in the background
+        :param image_pad: Padded image of the crops
+        :param crop_data: CropTable of the image
+        """
+        self.pending = self.worker.submit(self._score, image_pad, crop_data.image, crop_data.keys())
+
+    def _score(self, image_pad, image, keys):
+        cached_image, cached_keys, features = self.table_features
+        # The crops of an image are the same whatever their order
+        if cached_image != image:
+            positions = np.stack((keys >> 32, keys & 0xffffffff), axis=1)
+            features = crop_features(image_pad, positions, self.pad_size, self.crop_size, self.model.stopped)
+            if features is None:
+                return None
+            self.table_features = (image, keys, features)
+        else:
+            keys = cached_keys
+        return image, keys, self.model.uncertainty(features)
+
+    def apply(self, crop_data, start):
+        """
+        Reorder the crops not shown yet if a ranking of this crop table is ready
+        :param crop_data: CropTable being annotated
+        :param start: Index of the first crop not shown yet
+        """
+        if self.pending is None or not self.pending.done():
+            return
+        future, self.pending = self.pending, None
+        try:
+            result = future.result()
+        except Exception as e:
+            print("Ranking of the crops failed:", e)
+            return
+        if result is None:
+            # Stopped
+            return
+        image, keys, scores = result
+        if image == crop_data.image:
+            crop_data.reorder(start, keys, scores)
@@ -0,0 +1,100 @@
+"""
+Per-stage wall time instrumentation, enabled by setting the JUNCTION_TIMING environment variable
+to 1 before starting the annotator. When it is not set, timed() returns the functions unchanged and
+stage() returns a shared no-op context manager, so the instrumentation costs nothing
+"""
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+import bisect
+import csv
+import functools
+import json
+import os
+import threading
+import time
+
+ENABLED = os.environ.get("JUNCTION_TIMING", "0") not in ("", "0")
+# Upper bounds of the histogram buckets, in milliseconds
+BUCKETS_MS = [0.1, 0.3, 1, 3, 10, 30, 100, 300, 1000, 3000, 10000, float("inf")]
+
+_stats = {}
+_lock = threading.Lock()
+_null_stage = nullcontext()
+
+
+def record(name, duration):
+    """
+    Add a measure to the statistics of a stage
+    :param name: Name of the stage
+    :param duration: Wall time in seconds
+    """
+    duration_ms = duration * 1000
+    with _lock:
+        stats = _stats.setdefault(name, {"count": 0, "total_ms": 0., "min_ms": float("inf"), "max_ms": 0.,
+                                         "histogram": [0] * len(BUCKETS_MS)})
+        stats["count"] += 1
+        stats["total_ms"] += duration_ms
+        stats["min_ms"] = min(stats["min_ms"], duration_ms)
+        stats["max_ms"] = max(stats["max_ms"], duration_ms)
+        stats["histogram"][bisect.bisect_left(BUCKETS_MS, duration_ms)] += 1
+
+
+@contextmanager
+def _timed_stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def stage(name):
+    """
+    Context manager measuring a block of code
+    :param name: Name of the stage
+    """
+    if not ENABLED:
+        return _null_stage
+    return _timed_stage(name)
+
+
+def timed(name):
+    """
+    Decorator measuring each call of a function
+    :param name: Name of the stage
+    """
+    def decorator(fn):
+        if not ENABLED:
+            return fn
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def dump_report(directory):
+    """
+    Write the statistics of the session as JSON and CSV files in the given directory
+    :return: path of the JSON report, or None if the instrumentation is disabled
+    """
+    if not ENABLED or directory is None:
+        return None
+    with _lock:
+        stats = {name: dict(values, mean_ms=values["total_ms"] / values["count"]) for name, values in _stats.items()}
+
+    fname = os.path.join(directory, "timing_" + datetime.now().strftime("%Y%m%d%H%M%S"))
+    with open(fname + ".json", "w") as json_file:
+        json.dump({"buckets_ms": [str(b) for b in BUCKETS_MS], "stages": stats}, json_file, indent=1)
+    with open(fname + ".csv", "w", newline="") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(["stage", "count", "total_ms", "mean_ms", "min_ms", "max_ms"] + ["<=%s ms" % b for b in BUCKETS_MS])
+        for name, values in sorted(stats.items()):
+            writer.writerow([name, values["count"], values["total_ms"], values["mean_ms"], values["min_ms"], values["max_ms"]]
+                            + values["histogram"])
+    return fname + ".json"
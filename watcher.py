@@ -0,0 +1,85 @@
+import os
+import threading
+
+# Extensions of the images the loader can read; .npy images are only read by the lazy backend
+IMAGE_EXTENSIONS = (".tif", ".tiff")
+LAZY_IMAGE_EXTENSIONS = IMAGE_EXTENSIONS + (".npy",)
+
+
+def is_image_file(fname, lazy=False):
+    """
+    Check if a file name is an image the loader can read; hidden files such as .DS_Store are not
+    """
+    return not fname.startswith(".") and os.path.splitext(fname)[1].lower() in (LAZY_IMAGE_EXTENSIONS if lazy else IMAGE_EXTENSIONS)
+
+
+def list_images(path, lazy=False):
+    """
+    Images of a directory, in the order of os.listdir
+    """
+    return [fname for fname in os.listdir(path) if is_image_file(fname, lazy) and os.path.isfile(os.path.join(path, fname))]
+
+
+class DirectoryWatcher:
+
+    def __init__(self, path, known_files, lazy=False, interval=5.):
+        """
+        Poll a directory in a background thread for new images. A new file is only reported once its
+        size and modification time did not change between two polls, so that images still being
+        written by the acquisition software are not read
+        :param path: Directory of the images
+        :param known_files: Names of the files already in the work queue
+        :param lazy: Accept the file types of the lazy backend
+        :param interval: Time between two polls in seconds
+        """
+        self.path = path
+        self.lazy = lazy
+        self.interval = interval
+        self.known = set(known_files)
+        # Size and modification time of the new files at the previous poll
+        self.candidates = {}
+        self.ready = []
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="watcher", daemon=True)
+        self.thread.start()
+
+    def poll(self):
+        candidates = {}
+        try:
+            entries = list(os.scandir(self.path))
+        except OSError as e:
+            print("Could not list", self.path, ":", e)
+            return
+        for entry in entries:
+            if entry.name in self.known or not is_image_file(entry.name, self.lazy):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            if not entry.is_file():
+                continue
+            signature = (stat.st_size, stat.st_mtime)
+            if self.candidates.get(entry.name) == signature and stat.st_size > 0:
+                self.known.add(entry.name)
+                with self.lock:
+                    self.ready.append(entry.name)
+            else:
+                candidates[entry.name] = signature
+        self.candidates = candidates
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.poll()
+
+    def new_files(self):
+        """
+        Files that appeared since the last call, in the order they were found
+        """
+        with self.lock:
+            files, self.ready = self.ready, []
+        return files
+
+    def close(self):
+        self.stop_event.set()
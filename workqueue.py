@@ -0,0 +1,134 @@
+import os
+import sqlite3
+import time
+
+QUEUE_FILE_NAME = "queue.db"
+BLOCK_SIZE = 50
+LEASE_TIMEOUT = 600
+
+
+class WorkQueue:
+
+    def __init__(self, outputpath, annotator, block_size=BLOCK_SIZE, lease_timeout=LEASE_TIMEOUT):
+        """
+        Queue of the crops of a dataset shared by several annotators through a SQLite database in the
+        output directory. The crops of each image are split in blocks; an annotator claims a block,
+        holds a lease on it while annotating it and marks it done at the end. A block whose lease
+        expired, because its annotator quit or crashed, can be claimed by another annotator.
+        SQLite serializes the claims with its file lock, which needs a filesystem with working locks
+        :param outputpath: Directory shared by the annotators
+        :param annotator: Name of the annotator, unique among the annotators of the dataset
+        :param block_size: Number of crops per block
+        :param lease_timeout: Time in seconds after which an unfinished block can be claimed again
+        """
+        self.annotator = annotator
+        self.block_size = block_size
+        self.lease_timeout = lease_timeout
+        self.last_renewal = 0.
+
+        # isolation_level=None lets claim() open its own write transaction
+        self.connection = sqlite3.connect(os.path.join(outputpath, QUEUE_FILE_NAME), timeout=60, isolation_level=None)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS images (image TEXT PRIMARY KEY, n_crops INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS blocks (
+                image TEXT NOT NULL, block INTEGER NOT NULL, annotator TEXT, expires REAL,
+                done INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (image, block)
+            );
+        """)
+
+    def is_registered(self, image):
+        return self.connection.execute("SELECT 1 FROM images WHERE image=?", (image,)).fetchone() is not None
+
+    def register(self, image, n_crops):
+        """
+        Add the blocks of an image to the queue, unless another annotator did it already
+        :param image: Name of the image
+        :param n_crops: Number of crops of the image
+        """
+        n_blocks = (n_crops + self.block_size - 1) // self.block_size
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            if not self.is_registered(image):
+                self.connection.execute("INSERT INTO images VALUES (?, ?)", (image, n_crops))
+                self.connection.executemany("INSERT INTO blocks (image, block) VALUES (?, ?)",
+                                            [(image, block) for block in range(n_blocks)])
+            self.connection.execute("COMMIT")
+        except Exception:
+            self.connection.execute("ROLLBACK")
+            raise
+
+    def claim(self, images):
+        """
+        Lease the next block that is neither done nor leased by another annotator
+        :param images: Names of the images in the order they are annotated
+        :return: Name of the image and index of the block, or None if there is no block available
+        """
+        order = {image: i for i, image in enumerate(images)}
+        now = time.time()
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            available = self.connection.execute(
+                "SELECT image, block FROM blocks WHERE done=0 AND (annotator IS NULL OR annotator=? OR expires<?)",
+                (self.annotator, now)).fetchall()
+            available = [row for row in available if row[0] in order]
+            claim = None
+            if available:
+                claim = min(available, key=lambda row: (order[row[0]], row[1]))
+                self.connection.execute("UPDATE blocks SET annotator=?, expires=? WHERE image=? AND block=?",
+                                        (self.annotator, now + self.lease_timeout) + claim)
+            self.connection.execute("COMMIT")
+        except Exception:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.last_renewal = now
+        return claim
+
+    def reclaim(self, image, block):
+        """
+        Lease again a block annotated in a previous session, unless it is done or another annotator
+        holds it now
+        :return: True if the block is leased to the annotator
+        """
+        now = time.time()
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.connection.execute("SELECT annotator, expires, done FROM blocks WHERE image=? AND block=?",
+                                          (image, block)).fetchone()
+            claimed = row is not None and not row[2] and (row[0] is None or row[0] == self.annotator or row[1] < now)
+            if claimed:
+                self.connection.execute("UPDATE blocks SET annotator=?, expires=? WHERE image=? AND block=?",
+                                        (self.annotator, now + self.lease_timeout, image, block))
+            self.connection.execute("COMMIT")
+        except Exception:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.last_renewal = now
+        return claimed
+
+    def renew(self, image, block):
+        """
+        Extend the lease of a block held by the annotator; only written to the database when half of
+        the lease has passed
+        """
+        now = time.time()
+        if now - self.last_renewal < self.lease_timeout / 2:
+            return
+        self.connection.execute("UPDATE blocks SET expires=? WHERE image=? AND block=? AND annotator=? AND done=0",
+                                (now + self.lease_timeout, image, block, self.annotator))
+        self.last_renewal = now
+
+    def complete(self, image, block):
+        """
+        Mark a block as done, if the annotator still holds it
+        """
+        self.connection.execute("UPDATE blocks SET done=1 WHERE image=? AND block=? AND annotator=?", (image, block, self.annotator))
+
+    def release(self):
+        """
+        Give back the unfinished blocks of the annotator so that others can claim them right away
+        """
+        self.connection.execute("UPDATE blocks SET annotator=NULL, expires=NULL WHERE annotator=? AND done=0", (self.annotator,))
+
+    def close(self):
+        self.release()
+        self.connection.close()
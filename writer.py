@@ -0,0 +1,93 @@
+import queue
+import threading
+import time
+import timing
+
+FLUSH_STAGE = "write_commit"
+
+
+class BackgroundWriter:
+
+    def __init__(self, flush_fn, flush_every=20, flush_interval=0.5):
+        """
+        Run file writes in order in a dedicated thread, so that the interface never waits on the disk.
+        The files are committed in groups: flush_fn is called after flush_every writes, or flush_interval
+        seconds after the first write that is not committed yet, whichever comes first. The writes and
+        commits are measured as timing stages, since the callers only measure their submission
+        :param flush_fn: Function committing the written files to the disk
+        :param flush_every: Maximum number of writes between two commits
+        :param flush_interval: Maximum time in seconds a write waits for its commit
+        """
+        self.flush_fn = flush_fn
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+
+        self.tasks = queue.Queue()
+        self.errors = []
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, name="writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, stage, fn, *args):
+        """
+        Queue a write; the writes are run in the order they were submitted
+        :param stage: Name of the timing stage of the write
+        """
+        self.tasks.put((stage, fn, args))
+
+    def call(self, stage, fn, *args):
+        try:
+            with timing.stage(stage):
+                fn(*args)
+        except Exception as e:
+            print("Write failed:", e)
+            with self.lock:
+                self.errors.append(e)
+
+    def run(self):
+        pending = 0
+        deadline = None
+        while True:
+            try:
+                task = self.tasks.get(timeout=None if deadline is None else max(0., deadline - time.monotonic()))
+            except queue.Empty:
+                # The oldest write not committed waited flush_interval
+                self.call(FLUSH_STAGE, self.flush_fn)
+                pending, deadline = 0, None
+                continue
+            if task is None:
+                if pending:
+                    self.call(FLUSH_STAGE, self.flush_fn)
+                self.tasks.task_done()
+                return
+
+            stage, fn, args = task
+            self.call(stage, fn, *args)
+            pending += 1
+            if deadline is None:
+                deadline = time.monotonic() + self.flush_interval
+            if pending >= self.flush_every:
+                self.call(FLUSH_STAGE, self.flush_fn)
+                pending, deadline = 0, None
+            self.tasks.task_done()
+
+    def drain(self):
+        """
+        Wait until every queued write is done
+        """
+        self.tasks.join()
+
+    def take_errors(self):
+        """
+        Errors raised by the writes since the last call
+        """
+        with self.lock:
+            errors, self.errors = self.errors, []
+        return errors
+
+    def close(self):
+        """
+        Run the queued writes, commit them and stop the thread
+        """
+        self.tasks.put(None)
+        self.thread.join()